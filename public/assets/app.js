@@ -33,6 +33,16 @@ let lastTypingSentAt = 0;
 // --- ESTADO DE RESPUESTA ---
 let replyingToMessage = null; // { id, text, name }
 
+// --- HISTORIAL PAGINADO ---
+const MSG_PAGE = 50;
+const PEOPLE_PAGE = 50;
+let peopleQuery = '';
+let hasMorePeople = false;
+let peopleSearchTimer = null;
+let oldestLoadedId = null;
+let hasMoreHistory = false;
+let loadingHistory = false;
+
 // --- CACHÉ DE REACCIONES ---
 const reactionsByMessageId = {}; // { messageId: {heart:[userIds]} }
 
@@ -338,13 +348,26 @@ function connectWS() {
       }
 
       if (data.type === 'presence_snapshot' && Array.isArray(data.onlineUserIds)) {
+        Object.keys(onlineUsers).forEach(uid => { delete onlineUsers[uid]; });
         data.onlineUserIds.forEach(uid => { onlineUsers[String(uid)] = true; });
         loadChats();
         updateChatHeaderPresence();
         return;
       }
 
+      if (data.type === 'presence_delta') {
+        (data.online || []).forEach(uid => { onlineUsers[String(uid)] = true; });
+        (data.offline || []).forEach(uid => { onlineUsers[String(uid)] = false; });
+        updateChatHeaderPresence();
+        renderChatList();
+        return;
+      }
+
       if (data.type === 'new_message') { handleIncomingMessage(data); return; }
+      if (data.type === 'chat_read') {
+        if (String(data.userId) === String(currentUser.id)) loadChats();
+        return;
+      }
       if (data.type === 'message_reaction') { handleReactionUpdate(data); return; }
 
       if (data.type === 'user_status' || data.type === 'presence' || data.type === 'online_status') {
@@ -778,10 +801,15 @@ async function loadChats() {
   renderChatList();
 }
 
-async function loadPeople() {
-  const text = document.getElementById('people-search-input').value;
-  allUsers = await apiCall('/api/users') || [];
-  renderPeople(text);
+async function loadPeople(more = false) {
+  // la búsqueda la hace el servidor (índice por nombre y @usuario), por páginas
+  const input = document.getElementById('people-search-input');
+  if (!more) peopleQuery = input ? input.value.trim() : '';
+  const offset = more ? allUsers.length : 0;
+  const page = await apiCall(`/api/users?q=${encodeURIComponent(peopleQuery)}&limit=${PEOPLE_PAGE}&offset=${offset}`) || [];
+  allUsers = more ? allUsers.concat(page) : page;
+  hasMorePeople = page.length === PEOPLE_PAGE;
+  renderPeople();
 }
 
 async function loadStories() {
@@ -798,7 +826,7 @@ async function loadStories() {
         const av = getAvatarUrl(s.user.avatarSeed);
         return `
         <div class="story-card bg-black">
-            <img src="${s.image}" class="story-img">
+            <img src="${s.thumb || s.image}" data-full="${s.image}" class="story-img" loading="lazy" onclick="openStoryImage(this)">
             <div class="story-overlay">
                 <div class="story-user" onclick="viewOtherProfile('${s.user.id}')">
                     <img src="${av}" class="w-8 h-8 rounded-full border border-white">
@@ -810,6 +838,13 @@ async function loadStories() {
     }).join('');
 }
 
+function openStoryImage(img) {
+    // la miniatura se sustituye por el original solo al tocar la historia
+    if (!img.dataset.full || img.dataset.loaded) return;
+    img.dataset.loaded = '1';
+    img.src = img.dataset.full;
+}
+
 async function loadAdminData() {
   if (!currentUser.is_admin) return;
   const users = await apiCall('/api/admin/all_users');
@@ -1006,12 +1041,14 @@ function renderChatList() {
     const av = getAvatarUrl(c.otherUser.avatarSeed);
 
     const lastPreview = c.lastMessage ? c.lastMessage.text : 'Empezar chat';
-    const preview = (typeof lastPreview === 'string' && lastPreview.startsWith('data:image')) ? '📷 Foto'
-                  : (typeof lastPreview === 'string' && lastPreview.startsWith('data:audio')) ? '🎤 Nota de voz'
+    const lastKind = c.lastMessage ? c.lastMessage.kind : null;
+    const preview = (lastKind === 'image' || (typeof lastPreview === 'string' && lastPreview.startsWith('data:image'))) ? '📷 Foto'
+                  : (lastKind === 'audio' || (typeof lastPreview === 'string' && lastPreview.startsWith('data:audio'))) ? '🎤 Nota de voz'
                   : escapeHtml(lastPreview);
 
     const wsConnected = (ws && ws.readyState === WebSocket.OPEN);
-    const isOnline = wsConnected && (c.otherUser.is_online === true || onlineUsers[String(c.otherUser.id)] === true);
+    const known = onlineUsers[String(c.otherUser.id)];
+    const isOnline = wsConnected && (known !== undefined ? known : c.otherUser.is_online === true);
 
     const st = c.otherUser.status === 'Suspendido'
       ? '<span class="text-red-500 text-[10px] font-bold">SUSPENDIDO</span>'
@@ -1032,6 +1069,7 @@ function renderChatList() {
           </div>
           <div class="flex justify-between items-center">
             <p class="text-[14px] truncate pr-3 text-muted transition-theme">${preview}</p>
+            ${(c.unread > 0 && c.id !== activeChatId) ? `<span class="min-w-[20px] h-5 px-1.5 rounded-full bg-wow-500 text-white text-[11px] font-bold flex items-center justify-center shrink-0">${c.unread > 99 ? '99+' : c.unread}</span>` : ''}
           </div>
         </div>
       </div>`;
@@ -1040,10 +1078,9 @@ function renderChatList() {
   refreshIcons();
 }
 
-function renderPeople(ft="") {
+function renderPeople() {
   const c = document.getElementById('people-grid'); if (!c) return;
-  const q = ft.toLowerCase();
-  const f = allUsers.filter(u => (u.name||'').toLowerCase().includes(q) || (u.username||'').toLowerCase().includes(q));
+  const f = allUsers;
   if (f.length === 0) { c.innerHTML = `<div class="col-span-2 text-center text-muted mt-10"><p>No se encontraron resultados</p></div>`; return; }
   c.innerHTML = f.map(u => `
     <div class="flex flex-col items-center bg-bar p-5 rounded-[24px] hover:bg-white dark:hover:bg-slate-800 shadow-sm transition-theme cursor-pointer border border-theme"
@@ -1053,13 +1090,14 @@ function renderPeople(ft="") {
       <p class="text-xs text-muted mb-3 transition-theme">@${escapeHtml(u.username)}</p>
       <button onclick="event.stopPropagation(); startChat('${u.id}')" class="w-full py-2 bg-wow-100 dark:bg-slate-700 text-wow-600 dark:text-white text-xs font-bold rounded-xl hover:bg-wow-500 hover:text-white dark:hover:bg-wow-500 transition-all transition-theme">Mensaje</button>
     </div>
-  `).join('');
+  `).join('') + (hasMorePeople ? `
+    <button onclick="loadPeople(true)" class="col-span-2 py-3 text-sm font-bold text-wow-600 dark:text-white transition-theme">Cargar más</button>` : '');
   refreshIcons();
 }
 
 function filterPeople() {
-  const i = document.getElementById('people-search-input');
-  if (i) renderPeople(i.value);
+  if (peopleSearchTimer) clearTimeout(peopleSearchTimer);
+  peopleSearchTimer = setTimeout(() => loadPeople(), 200);
 }
 
 async function viewOtherProfile(uid) {
@@ -1115,14 +1153,20 @@ async function openChat(cid, oid, n, seed) {
   typingByChat[String(activeChatId)] = false;
   removeTypingIndicator();
 
-  const ms = await apiCall(`/api/chats/${cid}/messages`);
+  const ms = await apiCall(`/api/chats/${cid}/messages?limit=${MSG_PAGE}`);
   const c = document.getElementById('messages-container');
 
+  oldestLoadedId = (ms && ms.length) ? ms[0].id : null;
+  hasMoreHistory = !!ms && ms.length === MSG_PAGE;
+  loadingHistory = false;
+
   c.innerHTML = `<div class="flex justify-center my-6"><span class="text-[10px] font-bold tracking-wider text-muted uppercase bg-bar px-3 py-1 rounded-full shadow-sm transition-theme" style="background-color: var(--bar);">Inicio del chat</span></div>`;
   if (ms) ms.forEach(m => {
     const me = m.fromId === currentUser.id;
     appendMessageUI({ id: m.id, text: m.text, time: m.time, from: me ? 'me' : 'them', kind: m.kind, duration: m.duration, peaks: m.peaks, reactions: m.reactions, replyTo: m.replyTo }, false);
   });
+  c.onscroll = () => { if (c.scrollTop < 60) loadOlderMessages(); };
+  sendMarkRead(cid);
 
   document.getElementById('view-chat').style.transform = 'translateX(0)';
   scrollToBottom();
@@ -1131,6 +1175,28 @@ async function openChat(cid, oid, n, seed) {
   toggleSendButton();
 }
 
+async function loadOlderMessages() {
+  if (!activeChatId || !hasMoreHistory || loadingHistory || oldestLoadedId == null) return;
+  const cid = activeChatId;
+  loadingHistory = true;
+  const ms = await apiCall(`/api/chats/${cid}/messages?before=${oldestLoadedId}&limit=${MSG_PAGE}`);
+  loadingHistory = false;
+  if (!ms || cid !== activeChatId) return;
+
+  hasMoreHistory = ms.length === MSG_PAGE;
+  if (!ms.length) return;
+  oldestLoadedId = ms[0].id;
+
+  const c = document.getElementById('messages-container');
+  const anchor = c.querySelector('[id^="msg-"]');
+  const prevHeight = c.scrollHeight;
+  ms.forEach(m => {
+    const me = m.fromId === currentUser.id;
+    appendMessageUI({ id: m.id, text: m.text, time: m.time, from: me ? 'me' : 'them', kind: m.kind, duration: m.duration, peaks: m.peaks, reactions: m.reactions, replyTo: m.replyTo }, false, anchor);
+  });
+  c.scrollTop += c.scrollHeight - prevHeight;
+}
+
 function closeChat() {
   document.getElementById('view-chat').style.transform = 'translateX(100%)';
   removeTypingIndicator();
@@ -1141,7 +1207,13 @@ function closeChat() {
   loadChats();
 }
 
+function sendMarkRead(cid) {
+  if (!cid || !ws || ws.readyState !== WebSocket.OPEN) return;
+  ws.send(JSON.stringify({ type: 'mark_read', chatId: cid }));
+}
+
 function handleIncomingMessage(d) {
+  if (activeChatId === d.chatId && d.message.fromId !== currentUser.id) sendMarkRead(d.chatId);
   loadChats();
   if (activeChatId === d.chatId) {
     const m = d.message;
@@ -1751,7 +1823,7 @@ function updateHeartUI(messageId, reactions, animate=false) {
 // =========================
 // UI: APPEND MESSAGE + SWIPE TO REPLY
 // =========================
-function appendMessageUI(m, ani=false) {
+function appendMessageUI(m, ani=false, before=null) {
   const c = document.getElementById('messages-container'); if (!c) return;
   removeTypingIndicator();
 
@@ -1768,7 +1840,7 @@ function appendMessageUI(m, ani=false) {
   let content = `<span class="msg-text">${escapeHtml(m.text)}</span>`;
   let bubbleClass = me ? 'bubble-me' : 'bubble-them';
 
-  const isImage = (typeof m.text === 'string' && m.text.startsWith('data:image'));
+  const isImage = (m.kind === 'image') || (typeof m.text === 'string' && m.text.startsWith('data:image'));
   const isAudio = (m.kind === 'audio') || (typeof m.text === 'string' && m.text.startsWith('data:audio'));
 
   // Quote HTML
@@ -1812,14 +1884,15 @@ function appendMessageUI(m, ani=false) {
       </div>
     </div>`;
 
-  c.appendChild(d);
+  if (before) c.insertBefore(d, before);
+  else c.appendChild(d);
 
   // Add Swipe listeners
   const bubble = d.querySelector(`.${me ? 'bubble-me' : 'bubble-them'}`);
   addSwipeListeners(bubble, msgId, isImage ? '📷 Foto' : (isAudio ? '🎤 Nota de voz' : m.text), me);
 
   refreshIcons();
-  scrollToBottom();
+  if (!before) scrollToBottom();
 
   if (isAudio) initVoiceMessage(msgId, m.text, m.peaks || [], (typeof m.duration==='number'?m.duration:null), me);
 }
@@ -3,14 +3,179 @@ import os
 import uuid
 import time
 import asyncio
-from typing import List, Optional, Dict, Any
+import shutil
+import bisect
+import base64
+import hashlib
+import re
+import threading
+import heapq
+import sqlite3
+import io
+import gzip
+import hmac
+import mimetypes
+import math
+import sys
+import wave
+import array
+import multiprocessing
+import signal
+import stat
+import itertools
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Dict, Any, Callable, Tuple
 
 from fastapi import FastAPI, WebSocket, HTTPException, Depends, Response, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from passlib.context import CryptContext
+
+try:
+    import orjson  # opcional: codificación JSON más rápida
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image, ImageOps  # opcional: miniaturas y reescalado de imágenes
+except ImportError:
+    Image = ImageOps = None
+
+try:
+    import brotli  # opcional: variantes .br de los estáticos
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # opcional: Content-Encoding zstd en respuestas de la API
+except ImportError:
+    zstandard = None
+
+# --- RESPUESTAS ---
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_OFFLOAD_BYTES = 256 * 1024   # por encima se comprime fuera del loop
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+def dumps_compact(data) -> str:
+    """JSON compacto para la red (mismo formato que WebSocket.send_json)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass  # enteros de más de 64 bits, claves raras...: lo resuelve json
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+def dumps_bytes(data) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse con orjson si está instalado (mismo JSON compacto que antes)."""
 
-app = FastAPI()
+    def render(self, content) -> bytes:
+        return dumps_bytes(content)
+
+def accepted_encodings(accept: str) -> Dict[str, float]:
+    offered = {}
+    for part in accept.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        m = re.search(r"q=([0-9.]+)", params)
+        if m:
+            try:
+                q = float(m.group(1))
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            offered[name.strip().lower()] = q
+    return offered
+
+def pick_encoding(accept: str) -> Optional[str]:
+    offered = accepted_encodings(accept)
+    if zstandard is not None and "zstd" in offered:
+        return "zstd"
+    if "gzip" in offered:
+        return "gzip"
+    return None
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+class CompressionMiddleware:
+    """gzip/zstd para respuestas de texto completas (no streaming) por encima de COMPRESS_MIN_BYTES.
+
+    Se dejan tal cual las que ya traen Content-Encoding (estáticos precomprimidos), los
+    blobs y demás tipos binarios, los rangos y las respuestas en streaming."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = ""
+        for k, v in scope.get("headers", ()):
+            if k == b"accept-encoding":
+                accept = v.decode("latin-1")
+                break
+        encoding = pick_encoding(accept) if accept else None
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None
+        passthrough = False
+
+        async def wrapped(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                headers = {k.lower(): v for k, v in message.get("headers", ())}
+                ctype = headers.get(b"content-type", b"").decode("latin-1")
+                passthrough = (message["status"] != 200 or b"content-encoding" in headers
+                               or not ctype.startswith(COMPRESSIBLE_TYPES))
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough or start is None:
+                return await send(message)
+            body = message.get("body", b"")
+            if message.get("more_body") or len(body) < COMPRESS_MIN_BYTES:
+                # streaming o demasiado pequeña: sin comprimir
+                passthrough = True
+                await send(start)
+                return await send(message)
+            if len(body) >= COMPRESS_OFFLOAD_BYTES:
+                packed = await asyncio.to_thread(compress_body, body, encoding)
+            else:
+                packed = compress_body(body, encoding)
+            headers = [(k, v) for k, v in start.get("headers", ())
+                       if k.lower() not in (b"content-length", b"vary")]
+            vary = [v for k, v in start.get("headers", ()) if k.lower() == b"vary"]
+            vary_value = vary[0] if vary else b""
+            if b"accept-encoding" not in vary_value.lower():
+                vary_value = (vary_value + b", " if vary_value else b"") + b"Accept-Encoding"
+            headers += [(b"content-encoding", encoding.encode("latin-1")),
+                        (b"content-length", str(len(packed)).encode("latin-1")),
+                        (b"vary", vary_value)]
+            start["headers"] = headers
+            await send(start)
+            await send({"type": "http.response.body", "body": packed})
+
+        await self.app(scope, receive, wrapped)
+
+app = FastAPI(default_response_class=FastJSONResponse)
 
 @app.get("/")
 def read_root():
@@ -27,15 +192,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
 CHATS_FILE = os.path.join(DATA_DIR, "chats.json")
 STORIES_FILE = os.path.join(DATA_DIR, "stories.json")
+MESSAGES_DIR = os.path.join(DATA_DIR, "messages")
+BLOBS_DIR = os.path.join(DATA_DIR, "blobs")
 PUBLIC_DIR = os.path.join(BASE_DIR, "public")
 
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(MESSAGES_DIR, exist_ok=True)
+os.makedirs(BLOBS_DIR, exist_ok=True)
 os.makedirs(PUBLIC_DIR, exist_ok=True)
 
 # --- MODELOS ---
@@ -80,144 +250,2800 @@ def load_json(filepath: str, default):
         return default
 
 def save_json(filepath: str, data):
+    write_text(filepath, json.dumps(data, indent=2, ensure_ascii=False))
+
+def write_text(filepath: str, text: str):
+    # tmp + fsync + rename: un corte a mitad nunca deja el fichero a medias
+    tmp = filepath + ".tmp"
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
             f.flush()
             os.fsync(f.fileno())
+        os.replace(tmp, filepath)
     except Exception as e:
         print(f"Error guardando JSON: {e}")
 
 def now_ms() -> int:
     return int(time.time() * 1000)
 
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# --- ESCRITOR EN SEGUNDO PLANO ---
+FLUSH_INTERVAL_S = 0.25
+
+class PersistenceWriter:
+    """Hilo único que escribe a disco. mark(key, fn) agrupa: por muchas veces que se marque
+    una clave dentro de un intervalo, fn se ejecuta una sola vez en el siguiente flush."""
+
+    def __init__(self, interval: float = FLUSH_INTERVAL_S):
+        self.interval = interval
+        self._pending: Dict[str, Callable[[], None]] = {}
+        self._cond = threading.Condition()
+        self._busy = False
+        self._stopping = False
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._thread = threading.Thread(target=self._run, name="wow-writer", daemon=True)
+        self._thread.start()
+
+    def mark(self, key: str, fn: Callable[[], None]):
+        with self._cond:
+            self._pending[key] = fn
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending and self._stopping:
+                    return
+            # ventana de agrupación: lo que llegue mientras tanto sale en el mismo flush
+            if not self._stopping:
+                time.sleep(self.interval)
+            self._flush_pending()
+
+    def _flush_pending(self):
+        with self._cond:
+            jobs, self._pending = self._pending, {}
+            self._busy = True
+        t0 = time.perf_counter()
+        for key, fn in jobs.items():
+            try:
+                fn()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error persistiendo {key}: {e}")
+        ms = (time.perf_counter() - t0) * 1000
+        with self._cond:
+            self._busy = False
+            self.flushes += 1
+            self.last_flush_ms = ms
+            self.max_flush_ms = max(self.max_flush_ms, ms)
+            self._total_flush_ms += ms
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Bloquea hasta que no quede nada pendiente. No llamar desde el event loop."""
+        if not self._thread.is_alive():
+            # writer ya cerrado: lo que se haya marcado después se escribe aquí mismo
+            while self._pending:
+                self._flush_pending()
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def close(self, timeout: Optional[float] = None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "busy": self._busy,
+                "flushes": self.flushes,
+                "errors": self.errors,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+                "avg_flush_ms": round(self._total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            }
+
+writer = PersistenceWriter()
+
 # --- STORIES HELPERS ---
 STORY_TTL_MS = 24 * 60 * 60 * 1000  # 24h
 
-def load_stories_clean() -> List[dict]:
-    stories = load_json(STORIES_FILE, [])
-    t = now_ms()
-    cleaned = []
-    for s in stories:
+def story_user_public(u: dict) -> dict:
+    return {
+        "id": u.get("id"),
+        "username": u.get("username", ""),
+        "name": u.get("name", ""),
+        "avatarSeed": u.get("avatarSeed", ""),
+        "is_admin": bool(u.get("is_admin", False)),
+    }
+
+def chat_user_public(u: dict, is_online: bool) -> dict:
+    return {
+        "id": u.get("id"),
+        "name": u.get("name", ""),
+        "avatarSeed": u.get("avatarSeed", ""),
+        "status": "Suspendido" if u.get("is_banned") else ("En línea" if is_online else "Desconectado"),
+        "is_online": is_online,
+    }
+
+# --- BLOBS (imágenes / audio) ---
+BLOB_URL_PREFIX = "/api/blobs/"
+BLOB_EXT = {
+    "image/jpeg": "jpg", "image/png": "png", "image/gif": "gif", "image/webp": "webp",
+    "audio/webm": "webm", "audio/ogg": "ogg", "audio/wav": "wav", "audio/x-wav": "wav",
+    "audio/mpeg": "mp3", "audio/mp4": "m4a",
+}
+BLOB_MIME = {
+    "jpg": "image/jpeg", "png": "image/png", "gif": "image/gif", "webp": "image/webp",
+    "webm": "audio/webm", "ogg": "audio/ogg", "wav": "audio/wav", "mp3": "audio/mpeg",
+    "m4a": "audio/mp4", "bin": "application/octet-stream",
+}
+BLOB_ID_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,5}$")
+DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)[^,]*?;base64,", re.S)
+
+def is_media_data_url(text) -> bool:
+    return isinstance(text, str) and (text.startswith("data:image") or text.startswith("data:audio"))
+
+def media_kind(mime: str) -> Optional[str]:
+    if mime.startswith("image/"):
+        return "image"
+    if mime.startswith("audio/"):
+        return "audio"
+    return None
+
+class BlobStore:
+    """Ficheros direccionados por contenido: data/blobs/ab/<sha256>.<ext>. Subir lo mismo dos veces no duplica."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, blob_id: str) -> Optional[str]:
+        if not BLOB_ID_RE.match(blob_id or ""):
+            return None
+        return os.path.join(self.root, blob_id[:2], blob_id)
+
+    def mime(self, blob_id: str) -> str:
+        return BLOB_MIME.get(blob_id.rsplit(".", 1)[-1], "application/octet-stream")
+
+    def put(self, data: bytes, mime: str) -> str:
+        blob_id = f"{hashlib.sha256(data).hexdigest()}.{BLOB_EXT.get(mime, 'bin')}"
+        path = self.path(blob_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        return blob_id
+
+    def put_data_url(self, data_url: str) -> Optional[str]:
+        """Decodifica un data:...;base64 y devuelve la URL del blob (None si no es válido)."""
+        m = DATA_URL_RE.match(data_url or "")
+        if not m:
+            return None
         try:
-            exp = int(s.get("expiresAt") or 0)
-            if exp <= t:
-                continue
-            cleaned.append(s)
+            data = base64.b64decode(data_url[m.end():], validate=False)
         except Exception:
+            return None
+        if not data:
+            return None
+        return BLOB_URL_PREFIX + self.put(data, m.group(1).lower())
+
+    def delete(self, blob_id: str):
+        path = self.path(blob_id)
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+STORY_THUMB_PX = 480
+
+def make_thumbnail(blob_id: Optional[str]) -> Optional[str]:
+    """Versión JPEG reducida de una imagen guardada. None sin Pillow o si no compensa."""
+    path = blobs.path(blob_id) if blob_id else None
+    if Image is None or not path:
+        return None
+    try:
+        with Image.open(path) as im:
+            im.thumbnail((STORY_THUMB_PX, STORY_THUMB_PX * 2))
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=70, optimize=True)
+    except Exception:
+        return None
+    data = buf.getvalue()
+    if len(data) >= os.path.getsize(path):
+        return None
+    return BLOB_URL_PREFIX + blobs.put(data, "image/jpeg")
+
+def blob_id_from_url(url) -> Optional[str]:
+    if isinstance(url, str) and url.startswith(BLOB_URL_PREFIX):
+        return url[len(BLOB_URL_PREFIX):]
+    return None
+
+def iter_file(path: str, start: int, end: int, chunk_size: int = 64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+blobs = BlobStore(BLOBS_DIR)
+
+def externalize_media(m: dict) -> bool:
+    """Pasa a blobs los data: URL de un mensaje (y de su replyTo). True si cambió algo."""
+    changed = False
+    txt = m.get("text")
+    if is_media_data_url(txt):
+        url = blobs.put_data_url(txt)
+        if url:
+            m.setdefault("kind", media_kind(txt[5:]))
+            m["text"] = url
+            changed = True
+    rt = m.get("replyTo")
+    if isinstance(rt, dict) and is_media_data_url(rt.get("text")):
+        url = blobs.put_data_url(rt["text"])
+        if url:
+            rt["kind"] = rt.get("kind") or media_kind(rt["text"][5:])
+            rt["text"] = url
+            changed = True
+    return changed
+
+# --- INGESTA DE MEDIOS ---
+# Decodificar, reescalar imágenes y analizar audio es CPU pura: se hace en un pool de
+# procesos y el mensaje se emite cuando el blob definitivo está escrito. Es fork a
+# propósito: con spawn/forkserver cada hijo reimportaría este módulo (cargaría el store
+# entero y abriría la base de datos); a cambio, cada hijo cierra al arrancar los sockets
+# que hereda (escucha, clientes, bus). Sin fork/semáforos (p. ej. serverless) se degrada
+# a un pool de hilos.
+MEDIA_WORKERS = int(os.environ.get("WOW_MEDIA_WORKERS", "2"))
+MEDIA_IMAGE_MAX_PX = 1600
+MEDIA_IMAGE_QUALITY = 82
+MEDIA_PEAK_BARS = 64            # mismas barras que compressPeaks() en el cliente
+MEDIA_PEAK_WINDOW_S = 0.085     # ~4096 muestras a 48 kHz, como el ScriptProcessor del cliente
+
+_media_pool = None
+
+def _media_worker_init():
+    """(En cada hijo del pool) suelta lo heredado del servidor: señales y sockets."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # el padre decide cuándo se cierra el pool
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        signal.set_wakeup_fd(-1)
+    except ValueError:
+        pass
+    fd_dir = "/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"
+    try:
+        fds = [int(fd) for fd in os.listdir(fd_dir)]
+    except OSError:
+        return
+    for fd in fds:
+        if fd <= 2:
             continue
-    if len(cleaned) != len(stories):
-        save_json(STORIES_FILE, cleaned)
-    return cleaned
+        try:
+            # las colas del pool son pipes; los sockets son todos del servidor
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.close(fd)
+        except OSError:
+            pass
 
-def story_user_public(u: dict) -> dict:
+def media_executor():
+    global _media_pool
+    if _media_pool is None:
+        try:
+            ctx = multiprocessing.get_context("fork")
+            _media_pool = ProcessPoolExecutor(max_workers=MEDIA_WORKERS, mp_context=ctx,
+                                              initializer=_media_worker_init)
+        except (ValueError, OSError, NotImplementedError):
+            _media_pool = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+    return _media_pool
+
+def _degrade_media_pool(broken):
+    global _media_pool
+    if _media_pool is broken:
+        broken.shutdown(wait=False, cancel_futures=True)
+        _media_pool = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+    return _media_pool
+
+async def run_media(fn, *args):
+    loop = asyncio.get_running_loop()
+    pool = media_executor()
+    try:
+        fut = loop.run_in_executor(pool, fn, *args)
+    except (BrokenProcessPool, OSError):
+        # no se pudieron crear los procesos (fork sin memoria, sin /dev/shm...)
+        fut = loop.run_in_executor(_degrade_media_pool(pool), fn, *args)
+        return await fut
+    try:
+        return await fut
+    except BrokenProcessPool:
+        # un hijo murió (OOM, señal): el trabajo se repite en hilos; los errores
+        # del propio process_media se propagan tal cual
+        return await loop.run_in_executor(_degrade_media_pool(pool), fn, *args)
+
+@app.on_event("shutdown")
+async def stop_media_pool():
+    if _media_pool is not None:
+        _media_pool.shutdown(wait=False, cancel_futures=True)
+
+def downscale_image(data: bytes, mime: str) -> Tuple[bytes, str]:
+    """Limita el lado mayor a MEDIA_IMAGE_MAX_PX y recomprime; devuelve el original si no gana."""
+    if Image is None or mime == "image/gif":   # los GIF pueden ser animados
+        return data, mime
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            im.draft("RGB", (MEDIA_IMAGE_MAX_PX, MEDIA_IMAGE_MAX_PX))   # JPEG: decodifica ya reducido
+            im = ImageOps.exif_transpose(im)
+            resized = max(im.size) > MEDIA_IMAGE_MAX_PX
+            im.thumbnail((MEDIA_IMAGE_MAX_PX, MEDIA_IMAGE_MAX_PX))
+            buf = io.BytesIO()
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                im.save(buf, "PNG", optimize=True)
+                out_mime = "image/png"
+            else:
+                if im.mode not in ("RGB", "L"):
+                    im = im.convert("RGB")
+                im.save(buf, "JPEG", quality=MEDIA_IMAGE_QUALITY, optimize=True)
+                out_mime = "image/jpeg"
+    except Exception:
+        return data, mime
+    out = buf.getvalue()
+    if not resized and len(out) >= len(data):
+        return data, mime
+    return out, out_mime
+
+def wav_summary(data: bytes) -> Optional[dict]:
+    """Duración (s) y picos 0..1000 de un WAV PCM (lo que graba el fallback WebAudio)."""
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            channels, width, rate, frames = w.getnchannels(), w.getsampwidth(), w.getframerate(), w.getnframes()
+            raw = w.readframes(frames)
+    except (wave.Error, EOFError):
+        return None
+    code = {1: "B", 2: "h", 4: "i"}.get(width)
+    if not code or not rate or array.array(code).itemsize != width:
+        return None
+    samples = array.array(code)
+    samples.frombytes(raw[:len(raw) - len(raw) % width])
+    if sys.byteorder == "big" and width > 1:
+        samples.byteswap()
+    bias = 128 if width == 1 else 0
+    full_scale = float(1 << (8 * width - 1))
+    n = len(samples)
+    peaks = []
+    if n:
+        window = max(1, int(rate * channels * MEDIA_PEAK_WINDOW_S))
+        for i in range(MEDIA_PEAK_BARS):
+            lo, hi = i * n // MEDIA_PEAK_BARS, (i + 1) * n // MEDIA_PEAK_BARS
+            best = 0.0
+            for start in range(lo, hi, window):
+                seg = samples[start:min(hi, start + window)]
+                rms = math.sqrt(sum((v - bias) * (v - bias) for v in seg) / len(seg))
+                best = max(best, rms)
+            peaks.append(min(1000, round(best / full_scale * 1000)))
+    return {"duration": round(frames / rate), "peaks": peaks}
+
+def process_media(data_url: str, thumb: bool = False) -> Optional[dict]:
+    """(En el pool) data: URL -> blob definitivo. {"url", "thumb"?, "duration"?, "peaks"?} o None."""
+    m = DATA_URL_RE.match(data_url or "")
+    if not m:
+        return None
+    try:
+        data = base64.b64decode(data_url[m.end():], validate=False)
+    except Exception:
+        return None
+    if not data:
+        return None
+    mime = m.group(1).lower()
+    out: Dict[str, Any] = {}
+    if mime.startswith("image/"):
+        data, mime = downscale_image(data, mime)
+    elif mime in ("audio/wav", "audio/x-wav", "audio/wave"):
+        summary = wav_summary(data)
+        if summary:
+            out.update(summary)
+    blob_id = blobs.put(data, mime)
+    out["url"] = BLOB_URL_PREFIX + blob_id
+    if thumb:
+        thumb_url = make_thumbnail(blob_id)
+        if thumb_url:
+            out["thumb"] = thumb_url
+    return out
+
+# --- LOG DE MENSAJES ---
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+VOICE_MAX_S = 3600              # duración máxima aceptada para una nota de voz
+REACTION_MAX_LEN = 32
+# Con varios workers cada uno tiene una ranura y solo emite ids ≡ ranura (mód MSG_ID_SLOTS):
+# dos workers nunca dan el mismo id aunque coincida el milisegundo
+MSG_ID_SLOTS = 16
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+COMPACT_INTERVAL_S = 60
+COMPACT_MIN_DELTAS = 200
+
+class MessageLog:
+    """Un directorio por chat con segmentos JSON Lines de solo-append (000001.jsonl, ...).
+
+    Registros: {"op": "base"} abre un segmento compactado (lo anterior se ignora),
+    {"op": "msg", "msg": {...}} añade un mensaje, {"op": "react", ...} guarda el
+    estado resultante de una reacción y {"op": "meta", ...} el último estado del chat
+    (lastMessage, unread, readCursor), para no reescribir chats.json en cada mensaje.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _dir(self, cid: str) -> str:
+        return os.path.join(self.root, cid)
+
+    def _segments(self, cid: str) -> List[str]:
+        d = self._dir(cid)
+        if not os.path.isdir(d):
+            return []
+        return sorted(n for n in os.listdir(d) if n.endswith(".jsonl"))
+
+    def exists(self, cid: str) -> bool:
+        return bool(self._segments(cid))
+
+    def load(self, cid: str) -> List[dict]:
+        return self.load_state(cid)[0]
+
+    def load_state(self, cid: str) -> Tuple[List[dict], Optional[dict]]:
+        """(mensajes, último registro meta o None)."""
+        d = self._dir(cid)
+        records = []
+        for name in self._segments(cid):
+            with open(os.path.join(d, name), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except Exception:
+                        continue  # línea a medias tras un corte
+                    if rec.get("op") == "base":
+                        records = []
+                    records.append(rec)
+
+        messages: List[dict] = []
+        by_id: Dict[str, dict] = {}
+        meta = None
+        for rec in records:
+            op = rec.get("op")
+            if op == "meta":
+                meta = {k: rec[k] for k in CHAT_STATE_KEYS if k in rec}
+            elif op == "msg" and isinstance(rec.get("msg"), dict):
+                m = rec["msg"]
+                messages.append(m)
+                by_id[str(m.get("id"))] = m
+            elif op == "react":
+                m = by_id.get(str(rec.get("id")))
+                if not m:
+                    continue
+                lst = m.setdefault("reactions", {}).setdefault(rec.get("reaction"), [])
+                uid = rec.get("userId")
+                if rec.get("active") and uid not in lst:
+                    lst.append(uid)
+                elif not rec.get("active") and uid in lst:
+                    lst.remove(uid)
+        return messages, meta
+
+    def append(self, cid: str, text: str):
+        d = self._dir(cid)
+        os.makedirs(d, exist_ok=True)
+        segs = self._segments(cid)
+        name = segs[-1] if segs else "000001.jsonl"
+        path = os.path.join(d, name)
+        if segs and os.path.getsize(path) >= SEGMENT_MAX_BYTES:
+            path = os.path.join(d, "%06d.jsonl" % (int(name[:-6]) + 1))
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self, cid: str, text: str):
+        # Nuevo segmento "base" con el estado completo; se publica con rename atómico
+        # y solo después se borran los segmentos anteriores.
+        d = self._dir(cid)
+        os.makedirs(d, exist_ok=True)
+        segs = self._segments(cid)
+        seq = int(segs[-1][:-6]) + 1 if segs else 1
+        path = os.path.join(d, "%06d.jsonl" % seq)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for name in segs:
+            try:
+                os.remove(os.path.join(d, name))
+            except OSError:
+                pass
+
+    def drop(self, cid: str):
+        shutil.rmtree(self._dir(cid), ignore_errors=True)
+
+    def apply(self, ops: List[tuple]):
+        merged: List[tuple] = []
+        for op in ops:
+            # appends seguidos al mismo chat -> una sola escritura + fsync
+            if merged and op[0] == "append" and merged[-1][0] == "append" and merged[-1][1] == op[1]:
+                merged[-1] = ("append", op[1], merged[-1][2] + op[2])
+            else:
+                merged.append(op)
+        for op, cid, text in merged:
+            try:
+                if op == "append":
+                    self.append(cid, text)
+                elif op == "compact":
+                    self.compact(cid, text)
+                elif op == "drop":
+                    self.drop(cid)
+            except Exception as e:
+                print(f"Error en log de mensajes ({op} {cid}): {e}")
+
+def log_line(rec: dict) -> str:
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+CHAT_STATE_KEYS = ("lastMessage", "lastActivity", "unread", "readCursor")
+
+def chat_state(c: dict) -> dict:
+    # copias de unread/readCursor: se serializa en el hilo del writer
+    return {k: (dict(c[k]) if isinstance(c[k], dict) else c[k]) for k in CHAT_STATE_KEYS if k in c}
+
+def log_base(messages: List[dict], state: Optional[dict] = None) -> str:
+    text = log_line({"op": "base"}) + "".join(log_line({"op": "msg", "msg": m}) for m in messages)
+    if state:
+        text += log_line({"op": "meta", **state})
+    return text
+
+def msg_key(m: dict) -> int:
+    try:
+        return int(m.get("id") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def message_preview(m: dict) -> dict:
+    """Lo que la lista de chats necesita del último mensaje (sin replyTo ni reacciones)."""
+    text = m.get("text") or ""
+    return {
+        "id": m.get("id"),
+        "fromId": m.get("fromId"),
+        "text": text if m.get("kind") else text[:200],
+        "kind": m.get("kind"),
+        "time": m.get("time"),
+    }
+
+# --- BACKENDS DE PERSISTENCIA ---
+STORAGE_BACKEND = os.environ.get("WOW_STORAGE", "json").lower()
+SQLITE_PATH = os.environ.get("WOW_DB_PATH", os.path.join(DATA_DIR, "wow.db"))
+
+class StorageBackend:
+    """Interfaz de persistencia del DataStore.
+
+    load() se llama una vez al arrancar. El resto de métodos se llaman desde el loop
+    tras mutar la copia en memoria: solo serializan el registro y encolan el trabajo
+    en `writer`, nunca tocan disco en el loop.
+    """
+    name = ""
+
+    def bind(self, store: "DataStore"):
+        self.store = store
+
+    def load(self) -> Tuple[List[dict], List[dict], List[dict]]:
+        raise NotImplementedError
+
+    def put_user(self, u: dict):
+        raise NotImplementedError
+
+    def delete_user(self, user_id: str):
+        raise NotImplementedError
+
+    def put_chat(self, c: dict):
+        raise NotImplementedError
+
+    def update_chat(self, c: dict):
+        self.put_chat(c)
+
+    def delete_chat(self, cid: str):
+        raise NotImplementedError
+
+    def append_message(self, cid: str, msg: dict):
+        raise NotImplementedError
+
+    def record_reaction(self, cid: str, msg: dict, reaction: str, user_id: str, active: bool):
+        raise NotImplementedError
+
+    def put_story(self, story: dict):
+        raise NotImplementedError
+
+    def delete_stories(self, ids: List[str]):
+        raise NotImplementedError
+
+    # True si otros procesos pueden escribir en el mismo almacén (hay que releer)
+    shared = False
+
+    def load_user(self, user_id: str) -> Optional[dict]:
+        return None
+
+    def load_user_by_username(self, key: str) -> Optional[dict]:
+        return None
+
+    def load_chat(self, cid: str) -> Optional[dict]:
+        return None
+
+    # Ranura de ids de mensaje del worker (un solo proceso: todo el espacio de ids es suyo)
+    def claim_id_slot(self) -> int:
+        return 0
+
+    def release_id_slot(self, slot: int):
+        pass
+
+    # Reserva de nombres entre procesos (con un solo proceso basta el índice en memoria)
+    async def claim_username(self, key: str, user_id: str) -> bool:
+        return True
+
+    def release_username(self, key: str, user_id: str):
+        pass
+
+    def maintenance(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name}
+
+def chat_meta(c: dict) -> dict:
+    # copia también los dicts anidados (unread, readCursor) para serializar fuera del loop
+    return {k: (dict(v) if isinstance(v, dict) else v) for k, v in dict(c).items() if k != "messages"}
+
+class JsonStorage(StorageBackend):
+    """users.json / chats.json / stories.json reescritos enteros (agrupados por el writer)
+    y los mensajes en logs de solo-append por chat."""
+    name = "json"
+
+    def __init__(self):
+        self.log = MessageLog(MESSAGES_DIR)
+        self._files = {"users": USERS_FILE, "chats": CHATS_FILE, "stories": STORIES_FILE}
+        self._log_ops: deque = deque()
+        self._deltas: Dict[str, int] = {}
+        self._state_queue: deque = deque()     # chats con estado (unread, cursores...) por escribir
+        self._state_pending: set = set()
+
+    def load(self):
+        users = [u for u in load_json(USERS_FILE, []) if u.get("id")]
+
+        chats = []
+        migrated = False
+        for c in load_json(CHATS_FILE, []):
+            if not c.get("id"):
+                continue
+            inline = c.pop("messages", None)
+            if self.log.exists(c["id"]):
+                c["messages"], state = self.log.load_state(c["id"])
+                if state:
+                    c.update(state)   # más reciente que lo guardado en chats.json
+                externalized = False
+                for m in c["messages"]:
+                    externalized = externalize_media(m) or externalized
+                if externalized:
+                    self.log.compact(c["id"], log_base(c["messages"], chat_state(c)))
+            else:
+                # chats.json antiguo con los mensajes dentro: se pasan al log
+                c["messages"] = inline or []
+                for m in c["messages"]:
+                    externalize_media(m)
+                if inline:
+                    self.log.compact(c["id"], log_base(inline))
+            migrated = migrated or inline is not None
+            chats.append(c)
+        if migrated:
+            save_json(CHATS_FILE, [chat_meta(c) for c in chats])
+
+        stories = load_json(STORIES_FILE, [])
+        stories_migrated = False
+        for s in stories:
+            if is_media_data_url(s.get("image")):
+                url = blobs.put_data_url(s["image"])
+                if url:
+                    s["image"] = url
+                    stories_migrated = True
+        if stories_migrated:
+            save_json(STORIES_FILE, stories)
+
+        return users, chats, stories
+
+    # se ejecuta en el hilo del writer
+    def _snapshot(self, kind: str):
+        # list(...) y dict(...) son copias atómicas con el GIL: el loop puede seguir
+        # mutando mientras el writer serializa sin romper la iteración.
+        if kind == "users":
+            return [dict(u) for u in list(self.store.users.values())]
+        if kind == "chats":
+            return [chat_meta(c) for c in list(self.store.chats.values())]
+        return [dict(s) for s in list(self.store.stories.values())]
+
+    def _mark(self, kind: str):
+        path = self._files[kind]
+        writer.mark(kind, lambda: save_json(path, self._snapshot(kind)))
+
+    def _log(self, op: tuple):
+        self._log_ops.append(op)
+        writer.mark("log", self._flush_log)
+
+    def _flush_log(self):
+        ops = []
+        while self._log_ops:
+            op = self._log_ops.popleft()
+            if op[0] == "compact":
+                op = ("compact", op[1], log_base(*op[2]))
+            ops.append(op)
+        last = {op[1]: i for i, op in enumerate(ops)}
+        while self._state_queue:
+            cid = self._state_queue.popleft()
+            self._state_pending.discard(cid)     # un cambio posterior vuelve a encolarlo
+            c = self.store.chats.get(cid)
+            if c is None:
+                continue
+            line = log_line({"op": "meta", **chat_state(c)})
+            i = last.get(cid)
+            if i is not None and ops[i][0] == "append":
+                ops[i] = ("append", cid, ops[i][2] + line)   # mismo write + fsync que sus mensajes
+            else:
+                last[cid] = len(ops)
+                ops.append(("append", cid, line))
+        self.log.apply(ops)
+
+    def put_user(self, u: dict):
+        self._mark("users")
+
+    def delete_user(self, user_id: str):
+        self._mark("users")
+
+    def put_chat(self, c: dict):
+        self._mark("chats")
+
+    def update_chat(self, c: dict):
+        # cada mensaje y cada mark_read: un registro meta en el log del chat (uno por flush)
+        cid = c["id"]
+        if cid not in self._state_pending:
+            self._state_pending.add(cid)
+            self._state_queue.append(cid)
+            self._deltas[cid] = self._deltas.get(cid, 0) + 1
+        writer.mark("log", self._flush_log)
+
+    def delete_chat(self, cid: str):
+        self._deltas.pop(cid, None)
+        self._log(("drop", cid, None))
+        self._mark("chats")
+
+    def append_message(self, cid: str, msg: dict):
+        self._log(("append", cid, log_line({"op": "msg", "msg": msg})))
+
+    def record_reaction(self, cid: str, msg: dict, reaction: str, user_id: str, active: bool):
+        rec = {"op": "react", "id": msg.get("id"), "reaction": reaction, "userId": user_id, "active": active}
+        self._log(("append", cid, log_line(rec)))
+        self._deltas[cid] = self._deltas.get(cid, 0) + 1
+
+    def put_story(self, story: dict):
+        self._mark("stories")
+
+    def delete_stories(self, ids: List[str]):
+        self._mark("stories")
+
+    def maintenance(self):
+        # compacta los chats con muchas reacciones o registros meta acumulados en el log
+        for cid, n in list(self._deltas.items()):
+            c = self.store.chats.get(cid)
+            if not c:
+                self._deltas.pop(cid, None)
+                continue
+            if n < max(COMPACT_MIN_DELTAS, len(c.get("messages", [])) // 4):
+                continue
+            self._deltas.pop(cid, None)
+            # en el loop solo la copia de la lista; el segmento base se serializa en el writer
+            self._log(("compact", cid, (list(c.get("messages", [])), chat_state(c))))
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "log_backlog": len(self._log_ops)}
+
+class SQLiteStorage(StorageBackend):
+    """SQLite en modo WAL. Las escrituras se agrupan en una transacción por flush del writer."""
+    name = "sqlite"
+    shared = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, username TEXT NOT NULL, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+    CREATE TABLE IF NOT EXISTS chats (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS chat_participants (
+        chat_id TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (chat_id, user_id));
+    CREATE INDEX IF NOT EXISTS idx_chat_participants_user ON chat_participants(user_id);
+    CREATE TABLE IF NOT EXISTS messages (
+        chat_id TEXT NOT NULL, id INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (chat_id, id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS stories (
+        id TEXT PRIMARY KEY, user_id TEXT NOT NULL, created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL, data TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_stories_expires ON stories(expires_at);
+    CREATE TABLE IF NOT EXISTS usernames (
+        key TEXT PRIMARY KEY, user_id TEXT NOT NULL, claimed_at REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS id_slots (slot INTEGER PRIMARY KEY, pid INTEGER NOT NULL);
+    """
+    CLAIM_STALE_S = 60     # reservas sin usuario detrás (proceso caído a mitad de registro)
+    DRAIN_RETRIES = 20     # flushes seguidos con la base bloqueada antes de dar el lote por perdido
+
+    def __init__(self, path: str):
+        self.path = path
+        # una sola conexión: lecturas al arrancar y escrituras solo desde el hilo del writer
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.reader = sqlite3.connect(path, check_same_thread=False)  # lecturas puntuales desde el loop
+        # reservas de nombre: en autocommit, la PRIMARY KEY hace de cerrojo entre workers. Van
+        # en un hilo propio (nunca en el loop: pueden esperar al lock de escritura) y en orden
+        # FIFO, para que una liberación no adelante a una reserva posterior del mismo nombre.
+        self.claims = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._claims_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="claims")
+        self._ops: deque = deque()
+        self._unflushed: Dict[str, int] = {}   # user_id -> escrituras encoladas aún sin confirmar
+        self._retries = 0
+
+    def load(self):
+        users = [json.loads(d) for (d,) in self.db.execute("SELECT data FROM users ORDER BY rowid")]
+        with self.db:
+            self.db.execute("DELETE FROM usernames WHERE claimed_at < ? AND user_id NOT IN (SELECT id FROM users)",
+                            (time.time() - self.CLAIM_STALE_S,))
+            self.db.executemany("INSERT OR IGNORE INTO usernames (key, user_id, claimed_at) VALUES (?, ?, 0)",
+                                [(u.get("username", "").lower(), u["id"]) for u in users])
+        chats = []
+        for cid, d in self.db.execute("SELECT id, data FROM chats ORDER BY rowid").fetchall():
+            c = json.loads(d)
+            c["messages"] = [json.loads(m) for (m,) in self.db.execute(
+                "SELECT data FROM messages WHERE chat_id = ? ORDER BY id", (cid,))]
+            chats.append(c)
+        stories = [json.loads(d) for (d,) in self.db.execute("SELECT data FROM stories ORDER BY created_at")]
+        return users, chats, stories
+
+    def load_user(self, user_id: str) -> Optional[dict]:
+        if self._unflushed.get(user_id):
+            # lo escrito aquí aún no ha llegado a la base: la copia en memoria es la buena
+            u = self.store.users.get(user_id)
+            return dict(u) if u else None
+        row = self.reader.execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_user_by_username(self, key: str) -> Optional[dict]:
+        row = self.reader.execute("SELECT user_id FROM usernames WHERE key = ?", (key,)).fetchone()
+        return self.load_user(row[0]) if row else None
+
+    def load_chat(self, cid: str) -> Optional[dict]:
+        row = self.reader.execute("SELECT data FROM chats WHERE id = ?", (cid,)).fetchone()
+        if not row:
+            return None
+        c = json.loads(row[0])
+        c["messages"] = [json.loads(m) for (m,) in self.reader.execute(
+            "SELECT data FROM messages WHERE chat_id = ? ORDER BY id", (cid,))]
+        return c
+
+    def _claim_id_slot(self) -> int:
+        # se liberan las ranuras de procesos que ya no existen (o de un arranque anterior
+        # con nuestro mismo pid) y se toma la primera libre, todo bajo el lock de escritura
+        self.claims.execute("BEGIN IMMEDIATE")
+        try:
+            taken = set()
+            for slot, pid in self.claims.execute("SELECT slot, pid FROM id_slots").fetchall():
+                if pid != os.getpid() and pid_alive(pid):
+                    taken.add(slot)
+                else:
+                    self.claims.execute("DELETE FROM id_slots WHERE slot = ?", (slot,))
+            free = [n for n in range(MSG_ID_SLOTS) if n not in taken]
+            if not free:
+                raise RuntimeError(f"Más de {MSG_ID_SLOTS} workers sobre {self.path}")
+            self.claims.execute("INSERT INTO id_slots (slot, pid) VALUES (?, ?)", (free[0], os.getpid()))
+        except BaseException:
+            self.claims.execute("ROLLBACK")
+            raise
+        self.claims.execute("COMMIT")
+        return free[0]
+
+    def claim_id_slot(self) -> int:
+        # una vez por worker al arrancar: se puede esperar aquí
+        return self._claims_pool.submit(self._claim_id_slot).result()
+
+    def _release_id_slot(self, slot: int):
+        try:
+            self.claims.execute("DELETE FROM id_slots WHERE slot = ? AND pid = ?", (slot, os.getpid()))
+        except sqlite3.Error as e:
+            print(f"Error liberando ranura de ids: {e}")
+
+    def release_id_slot(self, slot: int):
+        self._claims_pool.submit(self._release_id_slot, slot).result()
+
+    def _claim(self, key: str, user_id: str) -> bool:
+        self.claims.execute("INSERT OR IGNORE INTO usernames (key, user_id, claimed_at) VALUES (?, ?, ?)",
+                            (key, user_id, time.time()))
+        row = self.claims.execute("SELECT user_id FROM usernames WHERE key = ?", (key,)).fetchone()
+        return bool(row) and row[0] == user_id
+
+    def _release(self, key: str, user_id: str):
+        try:
+            self.claims.execute("DELETE FROM usernames WHERE key = ? AND user_id = ?", (key, user_id))
+        except sqlite3.Error as e:
+            print(f"Error liberando nombre: {e}")
+
+    async def claim_username(self, key: str, user_id: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(self._claims_pool, self._claim, key, user_id)
+
+    def release_username(self, key: str, user_id: str):
+        self._claims_pool.submit(self._release, key, user_id)
+
+    def _queue(self, sql: str, params: tuple, user_id: Optional[str] = None):
+        if user_id:
+            self._unflushed[user_id] = self._unflushed.get(user_id, 0) + 1
+        self._ops.append((sql, params, user_id))
+        writer.mark("sqlite", self._drain)
+
+    def _drain(self):
+        ops = []
+        while self._ops:
+            ops.append(self._ops.popleft())
+        if not ops:
+            return
+        try:
+            with self.db:
+                for sql, params, _ in ops:
+                    self.db.execute(sql, params)
+        except Exception as e:
+            if "locked" in str(e) and self._retries < self.DRAIN_RETRIES:
+                # "database is locked" con varios workers: el lote vuelve delante de la
+                # cola, en orden, y se reintenta en el siguiente flush
+                self._retries += 1
+                self._ops.extendleft(reversed(ops))
+                writer.mark("sqlite", self._drain)
+            else:
+                # no se puede escribir: se descarta, pero load_user vuelve a leer la base
+                self._retries = 0
+                self._settle(ops)
+            raise
+        self._retries = 0
+        self._settle(ops)
+
+    def _settle(self, ops: List[tuple]):
+        for _, _, user_id in ops:
+            if user_id:
+                n = self._unflushed.get(user_id, 0) - 1
+                if n > 0:
+                    self._unflushed[user_id] = n
+                else:
+                    self._unflushed.pop(user_id, None)
+
+    @staticmethod
+    def _user_row(u: dict) -> tuple:
+        return (u["id"], u.get("username", ""), json.dumps(u, ensure_ascii=False))
+
+    @staticmethod
+    def _story_row(s: dict) -> tuple:
+        return (s["id"], s.get("userId", ""), int(s.get("createdAt") or 0), int(s.get("expiresAt") or 0),
+                json.dumps(s, ensure_ascii=False))
+
+    def put_user(self, u: dict):
+        self._queue("INSERT INTO users (id, username, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET username = excluded.username, data = excluded.data",
+                    self._user_row(u), u["id"])
+
+    def delete_user(self, user_id: str):
+        self._queue("DELETE FROM users WHERE id = ?", (user_id,), user_id)
+        self._queue("DELETE FROM usernames WHERE user_id = ?", (user_id,))
+
+    def put_chat(self, c: dict):
+        self._queue("INSERT INTO chats (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    (c["id"], json.dumps(chat_meta(c), ensure_ascii=False)))
+        for p in c.get("participants", []):
+            self._queue("INSERT OR IGNORE INTO chat_participants (chat_id, user_id) VALUES (?, ?)", (c["id"], p))
+
+    def update_chat(self, c: dict):
+        self._queue("UPDATE chats SET data = ? WHERE id = ?", (json.dumps(chat_meta(c), ensure_ascii=False), c["id"]))
+
+    def delete_chat(self, cid: str):
+        self._queue("DELETE FROM messages WHERE chat_id = ?", (cid,))
+        self._queue("DELETE FROM chat_participants WHERE chat_id = ?", (cid,))
+        self._queue("DELETE FROM chats WHERE id = ?", (cid,))
+
+    def append_message(self, cid: str, msg: dict):
+        self._queue("INSERT OR REPLACE INTO messages (chat_id, id, data) VALUES (?, ?, ?)",
+                    (cid, msg_key(msg), json.dumps(msg, ensure_ascii=False)))
+
+    def record_reaction(self, cid: str, msg: dict, reaction: str, user_id: str, active: bool):
+        self._queue("UPDATE messages SET data = ? WHERE chat_id = ? AND id = ?",
+                    (json.dumps(msg, ensure_ascii=False), cid, msg_key(msg)))
+
+    def put_story(self, story: dict):
+        self._queue("INSERT OR REPLACE INTO stories (id, user_id, created_at, expires_at, data) VALUES (?, ?, ?, ?, ?)",
+                    self._story_row(story))
+
+    def delete_stories(self, ids: List[str]):
+        for sid in ids:
+            self._queue("DELETE FROM stories WHERE id = ?", (sid,))
+
+    @staticmethod
+    def _rekey_messages(msgs: List[dict]) -> int:
+        """Ids únicos y crecientes para la clave (chat_id, id); devuelve cuántos ha cambiado.
+
+        Los logs antiguos pueden traer dos mensajes con el mismo milisegundo o ids no
+        numéricos: con INSERT OR REPLACE uno pisaría al otro. Se conserva el orden del log.
+        """
+        changed, last = 0, None
+        for m in msgs:
+            mid = m.get("id")
+            try:
+                key = int(mid)
+            except (TypeError, ValueError):
+                key = None
+            if isinstance(mid, bool) or key is None or (last is not None and key <= last):
+                key = (last + 1) if last is not None else 0
+            if key != mid:
+                m["id"] = key
+                changed += 1
+            last = key
+        return changed
+
+    def import_all(self, users: List[dict], chats: List[dict], stories: List[dict]) -> Tuple[int, int]:
+        """Devuelve (mensajes escritos, mensajes a los que se les cambió el id)."""
+        rekeyed = sum(self._rekey_messages(c.get("messages", [])) for c in chats)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users (id, username, data) VALUES (?, ?, ?)",
+                                [self._user_row(u) for u in users])
+            self.db.executemany("INSERT OR IGNORE INTO usernames (key, user_id, claimed_at) VALUES (?, ?, 0)",
+                                [(u.get("username", "").lower(), u["id"]) for u in users])
+            for c in chats:
+                self.db.execute("INSERT OR REPLACE INTO chats (id, data) VALUES (?, ?)",
+                                (c["id"], json.dumps(chat_meta(c), ensure_ascii=False)))
+                self.db.executemany("INSERT OR IGNORE INTO chat_participants (chat_id, user_id) VALUES (?, ?)",
+                                    [(c["id"], p) for p in c.get("participants", [])])
+                self.db.executemany("INSERT OR REPLACE INTO messages (chat_id, id, data) VALUES (?, ?, ?)",
+                                    [(c["id"], msg_key(m), json.dumps(m, ensure_ascii=False))
+                                     for m in c.get("messages", [])])
+            self.db.executemany("INSERT OR REPLACE INTO stories (id, user_id, created_at, expires_at, data) "
+                                "VALUES (?, ?, ?, ?, ?)", [self._story_row(s) for s in stories])
+        written = sum(self.db.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (c["id"],)).fetchone()[0]
+                      for c in chats)
+        return written, rekeyed
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "pending_ops": len(self._ops)}
+
+def make_storage() -> StorageBackend:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    return JsonStorage()
+
+def migrate_json_to_sqlite(db_path: str):
+    """Copia data/*.json (y los logs de mensajes) a una base SQLite."""
+    users, chats, stories = JsonStorage().load()
+    n_msgs, rekeyed = SQLiteStorage(db_path).import_all(users, chats, stories)
+    print(f"Migrados {len(users)} usuarios, {len(chats)} chats, {n_msgs} mensajes y {len(stories)} historias a {db_path}")
+    if rekeyed:
+        print(f"  {rekeyed} mensajes con id repetido o no numérico han recibido un id nuevo")
+
+# --- BÚSQUEDA DE USUARIOS ---
+USERS_PAGE_SIZE = 50
+USERS_PAGE_MAX = 200
+
+def fold_text(text: str) -> str:
+    """Minúsculas y sin tildes: "jose" encuentra a "José"."""
+    text = unicodedata.normalize("NFKD", text or "").casefold()
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+def trigrams(word: str) -> set:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def user_public(u: dict) -> dict:
+    """Lo que necesita el directorio de personas."""
     return {
         "id": u.get("id"),
         "username": u.get("username", ""),
         "name": u.get("name", ""),
         "avatarSeed": u.get("avatarSeed", ""),
-        "is_admin": bool(u.get("is_admin", False)),
     }
 
+class UserSearchIndex:
+    """Índice de username y nombre: trigramas para términos de 3+ letras y una lista
+    ordenada de palabras para prefijos más cortos. Se mantiene usuario a usuario."""
+
+    def __init__(self):
+        self.grams: Dict[str, set] = {}                 # trigrama -> user_ids
+        self.words: List[Tuple[str, str]] = []          # (palabra, user_id), ordenada
+        self.docs: Dict[str, Tuple[str, Tuple[str, ...]]] = {}  # user_id -> (texto, palabras)
+
+    @staticmethod
+    def _doc(u: dict) -> Tuple[str, Tuple[str, ...]]:
+        username = fold_text(u.get("username", ""))
+        name = fold_text(u.get("name", ""))
+        words = tuple(w for w in dict.fromkeys([username] + name.split()) if w)
+        return f"{username} {name}", words
+
+    def add(self, u: dict):
+        uid = u["id"]
+        doc = self._doc(u)
+        if self.docs.get(uid) == doc:
+            return
+        self.remove(uid)
+        self.docs[uid] = doc
+        for w in doc[1]:
+            bisect.insort(self.words, (w, uid))
+        for g in set().union(*map(trigrams, doc[1])):
+            self.grams.setdefault(g, set()).add(uid)
+
+    def remove(self, uid: str):
+        doc = self.docs.pop(uid, None)
+        if not doc:
+            return
+        for w in doc[1]:
+            i = bisect.bisect_left(self.words, (w, uid))
+            if i < len(self.words) and self.words[i] == (w, uid):
+                del self.words[i]
+        for g in set().union(*map(trigrams, doc[1])):
+            ids = self.grams.get(g)
+            if ids:
+                ids.discard(uid)
+                if not ids:
+                    del self.grams[g]
+
+    def _prefix(self, term: str) -> set:
+        out = set()
+        i = bisect.bisect_left(self.words, (term, ""))
+        while i < len(self.words) and self.words[i][0].startswith(term):
+            out.add(self.words[i][1])
+            i += 1
+        return out
+
+    def _contains(self, term: str) -> set:
+        sets = sorted((self.grams.get(g, set()) for g in trigrams(term)), key=len)
+        if not sets or not sets[0]:
+            return set()
+        ids = set(sets[0]).intersection(*sets[1:])
+        return {u for u in ids if term in self.docs[u][0]}  # descarta falsos positivos
+
+    def search(self, query: str) -> Optional[List[str]]:
+        """Ids que contienen todos los términos, mejores primero. None si la consulta está vacía."""
+        terms = fold_text(query).split()
+        if not terms:
+            return None
+        found: Optional[set] = None
+        for t in terms:
+            ids = self._contains(t) if len(t) >= 3 else self._prefix(t)
+            found = ids if found is None else found & ids
+            if not found:
+                return []
+        first = terms[0]
+
+        def rank(uid):
+            words = self.docs[uid][1]
+            if words and words[0].startswith(first):
+                return (0, words[0])
+            return (1 if any(w.startswith(first) for w in words) else 2, words[0] if words else "")
+
+        return sorted(found, key=rank)
+
+# --- ALMACÉN EN MEMORIA ---
+class DataStore:
+    """Datos residentes en memoria con índices. Se cargan una vez al arrancar y se persisten en segundo plano."""
+
+    def __init__(self, backend: StorageBackend):
+        self.users: Dict[str, dict] = {}
+        self.users_by_username: Dict[str, str] = {}
+        self._reserved: Dict[str, str] = {}     # nombre en minúsculas -> user_id con un alta/cambio en curso
+        self.search = UserSearchIndex()
+        self.chats: Dict[str, dict] = {}
+        self.chats_by_user: Dict[str, Dict[str, None]] = {}
+        self.members: Dict[str, Tuple[str, ...]] = {}   # cid -> participantes (señalización, typing)
+        self.msg_ids: Dict[str, List[int]] = {}
+        self.msg_pos: Dict[str, Dict[int, int]] = {}    # cid -> id -> posición en messages
+        self.id_slot: Optional[int] = None             # ver MSG_ID_SLOTS; None hasta el arranque
+        self.stories: Dict[str, dict] = {}              # id -> historia, en orden de creación
+        self._story_heap: List[Tuple[int, str]] = []    # (expiresAt, id)
+        self.blob_refs: Dict[str, int] = {}             # blob -> mensajes e historias que lo usan
+        self.backend = backend
+        backend.bind(self)
+
+    def load(self):
+        users, chats, stories = self.backend.load()
+        for u in users:
+            self.users[u["id"]] = u
+            self.users_by_username[u.get("username", "").lower()] = u["id"]
+            self.search.add(u)
+        for c in chats:
+            self._index_chat(c)
+        # lista de chats de cada usuario ordenada por actividad (el último es el más reciente)
+        for uid, ids in self.chats_by_user.items():
+            ordered = sorted(ids, key=lambda cid: self.chats[cid].get("lastActivity") or 0)
+            self.chats_by_user[uid] = dict.fromkeys(ordered)
+        for s in stories:
+            self._index_story(s)
+
+    # usuarios
+    def get_user(self, user_id: Optional[str]) -> Optional[dict]:
+        if not user_id:
+            return None
+        return self.users.get(user_id)
+
+    def get_users(self, ids) -> Dict[str, dict]:
+        """Resuelve un lote de ids de una vez (los que no existen se omiten)."""
+        users = self.users
+        ids = set(ids)
+        if self.backend.shared:
+            # dados de alta en otro worker: se leen del backend la primera vez
+            for uid in ids - users.keys():
+                self.refresh_user(uid)
+        return {uid: users[uid] for uid in ids if uid in users}
+
+    def get_user_by_username(self, username: str) -> Optional[dict]:
+        key = (username or "").lower()
+        user_id = self.users_by_username.get(key)
+        if user_id is None and self.backend.shared:
+            # dado de alta en otro worker y aún no visto aquí
+            fresh = self.backend.load_user_by_username(key)
+            return self.apply_user(fresh) if fresh else None
+        return self.get_user(user_id)
+
+    async def reserve_username(self, username: str, user_id: str) -> bool:
+        """Aparta el nombre para user_id mientras dura un registro o cambio de perfil.
+
+        Comprobar y apartar en memoria ocurre antes del primer await, así que es atómico
+        en el loop; con un backend compartido además se reserva en él (ver claim_username).
+        """
+        key = username.lower()
+        owner = self.users_by_username.get(key) or self._reserved.get(key)
+        if owner is not None:
+            if owner != user_id:
+                return False
+            self._reserved[key] = user_id
+            return True
+        self._reserved[key] = user_id
+        try:
+            claimed = await self.backend.claim_username(key, user_id)
+        except BaseException:
+            self.release_username(username, user_id)
+            raise
+        if not claimed:
+            if self._reserved.get(key) == user_id:
+                del self._reserved[key]
+            return False
+        return True
+
+    def release_username(self, username: str, user_id: str):
+        """Libera una reserva que no llegó a usarse (no hace nada si add/update_user la consumió)."""
+        key = username.lower()
+        if self._reserved.get(key) != user_id:
+            return
+        del self._reserved[key]
+        if self.users_by_username.get(key) != user_id:
+            self.backend.release_username(key, user_id)
+
+    def add_user(self, u: dict):
+        self.users[u["id"]] = u
+        self.users_by_username[u.get("username", "").lower()] = u["id"]
+        self._reserved.pop(u.get("username", "").lower(), None)
+        self.search.add(u)
+        self.backend.put_user(u)
+        bus.publish("user_added", user=u)
+
+    def update_user(self, user_id: str, fields: dict) -> Optional[dict]:
+        u = self.users.get(user_id)
+        if not u:
+            return None
+        old_key = u.get("username", "").lower()
+        u.update(fields)
+        new_key = u.get("username", "").lower()
+        if self._reserved.get(new_key) == user_id:
+            del self._reserved[new_key]
+        if new_key != old_key:
+            if self.users_by_username.get(old_key) == user_id:
+                del self.users_by_username[old_key]
+                self.backend.release_username(old_key, user_id)
+            self.users_by_username[new_key] = user_id
+        self.search.add(u)
+        self.backend.put_user(u)
+        # el registro completo: el otro worker no puede releerlo, el writer aún no lo ha escrito
+        bus.publish("user_changed", user=u)
+        return u
+
+    def remove_user(self, user_id: str, propagate: bool = True) -> bool:
+        if not self._unindex_user(user_id):
+            return False
+        if propagate:
+            self.backend.delete_user(user_id)
+            bus.publish("user_removed", user_id=user_id)
+        return True
+
+    def _unindex_user(self, user_id: str) -> Optional[dict]:
+        u = self.users.pop(user_id, None)
+        if u:
+            key = u.get("username", "").lower()
+            if self.users_by_username.get(key) == user_id:
+                del self.users_by_username[key]
+            self.search.remove(user_id)
+        return u
+
+    def search_users(self, query: str, limit: int, offset: int = 0,
+                     exclude_id: Optional[str] = None) -> List[dict]:
+        ids = self.search.search(query)
+        if ids is None:
+            candidates = iter(self.users.values())
+        else:
+            candidates = (self.users[uid] for uid in ids if uid in self.users)
+        visible = (u for u in candidates if u["id"] != exclude_id and not u.get("is_banned", False))
+        return list(itertools.islice(visible, offset, offset + limit))
+
+    def refresh_user(self, user_id: str) -> Optional[dict]:
+        """Relee un usuario del backend compartido (lo pudo cambiar otro proceso)."""
+        if not self.backend.shared:
+            return self.get_user(user_id)
+        fresh = self.backend.load_user(user_id)
+        if not fresh:
+            self._unindex_user(user_id)
+            return None
+        return self.apply_user(fresh)
+
+    def apply_user(self, fresh: dict) -> dict:
+        """Vuelca en memoria un usuario leído del backend o recibido de otro worker."""
+        user_id = fresh["id"]
+        u = self.users.get(user_id)
+        if not u:
+            self.users[user_id] = u = fresh
+            self.users_by_username[u.get("username", "").lower()] = user_id
+            self.search.add(u)
+            return u
+        old_key = u.get("username", "").lower()
+        u.update(fresh)
+        if u.get("username", "").lower() != old_key:
+            if self.users_by_username.get(old_key) == user_id:
+                del self.users_by_username[old_key]
+            self.users_by_username[u.get("username", "").lower()] = user_id
+        self.search.add(u)
+        return u
+
+    # chats
+    def _index_chat(self, c: dict):
+        msgs = c.get("messages", [])
+        if "lastMessage" not in c:
+            c["lastMessage"] = message_preview(msgs[-1]) if msgs else None
+            c["lastActivity"] = msg_key(msgs[-1]) if msgs else 0  # los ids son ms
+        unread = c.setdefault("unread", {})
+        cursors = c.setdefault("readCursor", {})
+        for p in c.get("participants", []):
+            unread.setdefault(p, 0)
+            cursors.setdefault(p, None)
+        self.chats[c["id"]] = c
+        self.members[c["id"]] = tuple(c.get("participants", ()))
+        self.msg_ids[c["id"]] = ids = [msg_key(m) for m in msgs]
+        self.msg_pos[c["id"]] = {mid: i for i, mid in enumerate(ids)}
+        for m in msgs:
+            self._ref_blob(m.get("text"), 1)
+        for p in c.get("participants", []):
+            self.chats_by_user.setdefault(p, {})[c["id"]] = None
+
+    def _touch(self, c: dict):
+        for p in c.get("participants", []):
+            ids = self.chats_by_user.setdefault(p, {})
+            ids.pop(c["id"], None)
+            ids[c["id"]] = None
+
+    def get_chat(self, cid: Optional[str]) -> Optional[dict]:
+        if not cid:
+            return None
+        c = self.chats.get(cid)
+        if c is None and self.backend.shared:
+            # creado por otro worker y su aviso por el bus se perdió
+            c = self.backend.load_chat(cid)
+            if c:
+                self._index_chat(c)
+        return c
+
+    def chats_for_user(self, user_id: str) -> List[dict]:
+        """Chats del usuario, del más reciente al más antiguo."""
+        return [self.chats[cid] for cid in reversed(self.chats_by_user.get(user_id, {})) if cid in self.chats]
+
+    def members_of(self, cid: Optional[str]) -> Tuple[str, ...]:
+        return self.members.get(cid, ()) if cid else ()
+
+    def chat_partner(self, cid: Optional[str], user_id: str) -> Optional[str]:
+        """El otro participante del chat, o None si user_id no es miembro."""
+        members = self.members_of(cid)
+        if user_id not in members:
+            return None
+        return next((p for p in members if p != user_id), None)
+
+    def contacts_of(self, user_id: str) -> set:
+        """Usuarios con los que user_id tiene algún chat."""
+        out = set()
+        for cid in self.chats_by_user.get(user_id, ()):
+            c = self.chats.get(cid)
+            if c:
+                out.update(c.get("participants", ()))
+        out.discard(user_id)
+        return out
+
+    def find_chat_between(self, a: str, b: str) -> Optional[dict]:
+        common = self.chats_by_user.get(a, {}).keys() & self.chats_by_user.get(b, {}).keys()
+        for cid in common:
+            return self.chats[cid]
+        return None
+
+    # propagate=False: el cambio viene de otro worker, que ya lo ha persistido
+    def add_chat(self, c: dict, propagate: bool = True):
+        c.setdefault("lastActivity", now_ms())
+        c.setdefault("lastMessage", None)
+        self._index_chat(c)
+        if propagate:
+            self.backend.put_chat(c)
+            bus.publish("chat_added", chat=c)
+
+    def remove_chat(self, cid: str, propagate: bool = True) -> Optional[dict]:
+        c = self.chats.pop(cid, None)
+        if not c:
+            return None
+        for p in c.get("participants", []):
+            ids = self.chats_by_user.get(p)
+            if ids:
+                ids.pop(cid, None)
+                if not ids:
+                    del self.chats_by_user[p]
+        self.members.pop(cid, None)
+        self.msg_ids.pop(cid, None)
+        self.msg_pos.pop(cid, None)
+        for m in c.get("messages", []):
+            self._ref_blob(m.get("text"), -1)
+        if propagate:
+            self.backend.delete_chat(cid)
+            bus.publish("chat_removed", chat_id=cid)
+        return c
+
+    # mensajes
+    def claim_id_slot(self):
+        if self.id_slot is None:
+            self.id_slot = self.backend.claim_id_slot()
+
+    def release_id_slot(self):
+        if self.id_slot is not None:
+            self.backend.release_id_slot(self.id_slot)
+            self.id_slot = None
+
+    def next_message_id(self, cid: str) -> int:
+        """Id nuevo en el chat: milisegundos actuales, o el último + 1 si coinciden (creciente).
+
+        Con backend compartido se sube al siguiente valor ≡ id_slot (mód MSG_ID_SLOTS),
+        así los ids de distintos workers no coinciden nunca.
+        """
+        ids = self.msg_ids[cid]
+        mid = max(now_ms(), ids[-1] + 1 if ids else 0)
+        if self.backend.shared:
+            self.claim_id_slot()
+            mid += (self.id_slot - mid) % MSG_ID_SLOTS
+        return mid
+
+    def find_message(self, cid: str, message_id) -> Optional[dict]:
+        try:
+            pos = self.msg_pos[cid].get(int(message_id))
+        except (KeyError, TypeError, ValueError):
+            return None
+        return self.chats[cid]["messages"][pos] if pos is not None else None
+
+    def append_message(self, cid: str, msg: dict, propagate: bool = True):
+        c = self.chats[cid]
+        msgs = c.setdefault("messages", [])
+        ids = self.msg_ids[cid]
+        key = msg_key(msg)
+        if ids and key < ids[-1]:
+            # de otro worker y adelantado por uno local: se inserta en su sitio
+            pos = bisect.bisect_right(ids, key)
+            msgs.insert(pos, msg)
+            ids.insert(pos, key)
+            self.msg_pos[cid] = {mid: i for i, mid in enumerate(ids)}
+        else:
+            msgs.append(msg)
+            ids.append(key)
+            self.msg_pos[cid][key] = len(msgs) - 1
+            c["lastMessage"] = message_preview(msg)
+        self._ref_blob(msg.get("text"), 1)
+        c["lastActivity"] = now_ms()
+        for p in c.get("participants", []):
+            if p == msg.get("fromId"):
+                c["unread"][p] = 0
+                c["readCursor"][p] = msg.get("id")
+            else:
+                c["unread"][p] = c["unread"].get(p, 0) + 1
+        self._touch(c)
+        if propagate:
+            self.backend.append_message(cid, msg)
+            self.backend.update_chat(c)
+            bus.publish("message_appended", chat_id=cid, message=msg)
+
+    def mark_read(self, cid: str, user_id: str, message_id: Optional[int] = None, propagate: bool = True):
+        """Mueve el cursor de lectura del usuario; devuelve el id hasta el que ha leído."""
+        c = self.chats[cid]
+        ids = self.msg_ids[cid]
+        if message_id is None:
+            pos = len(ids)
+            cursor = c["messages"][-1].get("id") if ids else None
+        else:
+            pos = bisect.bisect_right(ids, message_id)
+            cursor = message_id
+        unread = len(ids) - pos
+        if c["unread"].get(user_id) != unread or c["readCursor"].get(user_id) != cursor:
+            c["unread"][user_id] = unread
+            c["readCursor"][user_id] = cursor
+            if propagate:
+                self.backend.update_chat(c)
+                bus.publish("chat_read", chat_id=cid, user_id=user_id, message_id=message_id)
+        return cursor
+
+    def record_reaction(self, cid: str, msg: dict, reaction: str, user_id: str, active: bool):
+        self.backend.record_reaction(cid, msg, reaction, user_id, active)
+        bus.publish("reaction", chat_id=cid, message_id=msg.get("id"), reaction=reaction,
+                    user_id=user_id, active=active)
+
+    def apply_reaction(self, cid: str, message_id, reaction: str, user_id: str, active: bool):
+        """Reacción hecha en otro worker (ya persistida allí)."""
+        msg = self.find_message(cid, message_id) if cid in self.chats else None
+        if not msg:
+            return
+        lst = msg.setdefault("reactions", {}).setdefault(reaction, [])
+        if active and user_id not in lst:
+            lst.append(user_id)
+        elif not active and user_id in lst:
+            lst.remove(user_id)
+
+    def page_messages(self, cid: str, before: Optional[int] = None, after: Optional[int] = None,
+                      limit: int = 50) -> List[dict]:
+        # Los ids son crecientes: bisect sobre msg_ids y solo se copia la página pedida.
+        msgs = self.chats[cid].get("messages", [])
+        ids = self.msg_ids[cid]
+        lo = bisect.bisect_right(ids, after) if after is not None else 0
+        hi = bisect.bisect_left(ids, before) if before is not None else len(ids)
+        if hi <= lo:
+            return []
+        if after is not None:
+            return msgs[lo:min(hi, lo + limit)]
+        return msgs[max(lo, hi - limit):hi]
+
+    # stories
+    def _ref_blob(self, url, delta: int) -> Optional[str]:
+        """Ajusta el contador del blob; devuelve su id si se ha quedado sin referencias."""
+        blob_id = blob_id_from_url(url)
+        if not blob_id:
+            return None
+        n = self.blob_refs.get(blob_id, 0) + delta
+        if n > 0:
+            self.blob_refs[blob_id] = n
+            return None
+        self.blob_refs.pop(blob_id, None)
+        return blob_id
+
+    def _index_story(self, story: dict):
+        try:
+            exp = int(story.get("expiresAt") or 0)
+        except (TypeError, ValueError):
+            exp = story["expiresAt"] = 0    # caducidad ilegible: se retira en el primer barrido
+        self.stories[story["id"]] = story
+        heapq.heappush(self._story_heap, (exp, story["id"]))
+        self._ref_blob(story.get("image"), 1)
+        self._ref_blob(story.get("thumb"), 1)
+
+    def active_stories(self) -> List[dict]:
+        # solo lectura: las caducadas las retira expire_stories() en segundo plano
+        t = now_ms()
+        return [s for s in self.stories.values() if (s.get("expiresAt") or 0) > t]
+
+    def add_story(self, story: dict, propagate: bool = True):
+        if story["id"] in self.stories:
+            return
+        self._index_story(story)
+        if propagate:
+            self.backend.put_story(story)
+            bus.publish("story_added", story=story)
+
+    def next_story_expiry(self) -> Optional[int]:
+        return self._story_heap[0][0] if self._story_heap else None
+
+    def expire_stories(self) -> Tuple[List[str], List[str]]:
+        """Retira las historias vencidas. Devuelve (ids retirados, blobs que ya nadie usa)."""
+        t = now_ms()
+        expired, orphans = [], []
+        while self._story_heap and self._story_heap[0][0] <= t:
+            _, sid = heapq.heappop(self._story_heap)
+            story = self.stories.pop(sid, None)
+            if story is None:
+                continue
+            expired.append(sid)
+            for url in (story.get("image"), story.get("thumb")):
+                orphan = self._ref_blob(url, -1)
+                if orphan:
+                    orphans.append(orphan)
+        if expired:
+            self.backend.delete_stories(expired)
+        return expired, orphans
+
+store = DataStore(make_storage())
+store.load()
+
+STORY_SWEEP_MAX_S = 60      # sin historias pendientes se vuelve a mirar cada minuto
+
+async def story_expiry_loop():
+    while True:
+        nxt = store.next_story_expiry()
+        delay = STORY_SWEEP_MAX_S if nxt is None else (nxt - now_ms()) / 1000
+        await asyncio.sleep(min(max(delay, 0), STORY_SWEEP_MAX_S))
+        try:
+            expired, orphans = store.expire_stories()
+            if orphans:
+                # se vuelve a mirar el contador: pudo reutilizarse mientras tanto
+                await asyncio.to_thread(lambda: [blobs.delete(b) for b in orphans if b not in store.blob_refs])
+            if expired:
+                await manager.broadcast({"type": "stories_updated"})
+        except Exception as e:
+            print(f"Error caducando historias: {e}")
+
+async def compaction_loop():
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL_S)
+        try:
+            store.backend.maintenance()
+        except Exception as e:
+            print(f"Error compactando: {e}")
+
+@app.on_event("startup")
+async def start_compaction():
+    asyncio.get_running_loop().create_task(compaction_loop())
+    asyncio.get_running_loop().create_task(story_expiry_loop())
+
+@app.on_event("startup")
+async def claim_message_id_slot():
+    # en el arranque de cada worker (no al importar: con --preload lo harían todos en el padre)
+    if store.backend.shared:
+        store.claim_id_slot()
+
+@app.on_event("shutdown")
+async def flush_store():
+    store.release_id_slot()
+    await asyncio.to_thread(writer.close)
+
+# --- BUS ENTRE WORKERS ---
+# Con un solo worker basta LocalBus. Con varios (uvicorn --workers N, siempre con
+# WOW_STORAGE=sqlite para que compartan los datos) se usa un broker local:
+#   WOW_BUS=unix:/tmp/wow-bus.sock   o   WOW_BUS=tcp:127.0.0.1:8765
+# Por el bus viajan también los cambios de chats, mensajes e historias, que cada
+# worker aplica a su copia en memoria (ver "Réplica del DataStore").
+# El broker solo acepta workers que presentan el secreto en el "hello": WOW_BUS_SECRET,
+# o si no data/bus.secret (0600), que crea el primero que arranca. El socket Unix
+# además queda en 0600.
+BUS_URL = os.environ.get("WOW_BUS", "local")
+BUS_RECONNECT_S = 1.0
+BUS_HELLO_TIMEOUT_S = 5.0
+BUS_SECRET_FILE = os.path.join(DATA_DIR, "bus.secret")
+
+def load_bus_secret() -> str:
+    secret = os.environ.get("WOW_BUS_SECRET", "")
+    if secret:
+        return secret
+    if not os.path.exists(BUS_SECRET_FILE):
+        # se escribe aparte y se publica con link(): nadie lee un fichero a medio escribir
+        tmp = f"{BUS_SECRET_FILE}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(os.urandom(32).hex())
+        try:
+            os.link(tmp, BUS_SECRET_FILE)
+        except FileExistsError:
+            pass    # otro worker se ha adelantado: vale el suyo
+        finally:
+            os.unlink(tmp)
+    with open(BUS_SECRET_FILE, encoding="utf-8") as f:
+        return f.read().strip()
+
+class LocalBus:
+    """Un único proceso: no hay otros workers a los que avisar.
+
+    Interfaz del bus: lo que se publica llega solo a los *otros* workers; el
+    que publica ya ha hecho la parte local.
+    """
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self.handlers: Dict[str, Callable] = {}
+        self.deliver: Optional[Callable] = None     # (message, user_ids | None) -> entrega local
+
+    def on(self, name: str, fn: Callable):
+        self.handlers[name] = fn
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def remote_online(self, user_id: str) -> bool:
+        return False
+
+    def remote_users(self) -> List[str]:
+        return []
+
+    def user_online(self, user_id: str):
+        pass
+
+    def user_offline(self, user_id: str):
+        pass
+
+    def send(self, user_ids: List[str], message: dict):
+        pass
+
+    def broadcast(self, message: dict):
+        pass
+
+    def publish(self, name: str, **data):
+        pass
+
+    def stats(self) -> dict:
+        return {"kind": "local", "worker": self.worker_id}
+
+async def open_bus_connection(url: str):
+    kind, _, addr = url.partition(":")
+    if kind == "unix":
+        return await asyncio.open_unix_connection(addr)
+    host, _, port = addr.rpartition(":")
+    return await asyncio.open_connection(host, int(port))
+
+class BusBroker:
+    """Reparte mensajes entre workers (JSON por líneas).
+
+    Sabe qué worker tiene sockets de cada usuario: los envíos dirigidos van solo a
+    ese worker y los cambios del mapa se reenvían a todos, que así comparten la
+    vista de quién está online en cualquier proceso.
+    """
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.workers: Dict[asyncio.StreamWriter, str] = {}
+        self.holders: Dict[str, set] = {}       # user_id -> writers de los workers con sockets suyos
+        self.server = None
+        self._lock_fd = None
+
+    @classmethod
+    async def serve(cls, url: str, secret: str) -> "BusBroker":
+        broker = cls(secret)
+        kind, _, addr = url.partition(":")
+        if kind == "unix":
+            import fcntl
+            # solo quien tiene el lock puede borrar un socket huérfano y escuchar
+            fd = os.open(addr + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                raise
+            broker._lock_fd = fd
+            if os.path.exists(addr):
+                os.unlink(addr)
+            broker.server = await asyncio.start_unix_server(broker._handle, addr)
+            os.chmod(addr, 0o600)
+        else:
+            host, _, port = addr.rpartition(":")
+            broker.server = await asyncio.start_server(broker._handle, host, int(port))
+        return broker
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for w in list(self.workers):
+            w.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _write(self, w: asyncio.StreamWriter, msg: dict):
+        try:
+            w.write(dumps_compact(msg).encode("utf-8") + b"\n")
+        except Exception:
+            pass
+
+    def _others(self, sender):
+        return [w for w in self.workers if w is not sender]
+
+    async def _authenticate(self, reader: asyncio.StreamReader) -> Optional[str]:
+        """Primera línea: {"op": "hello", "worker", "secret"}. Devuelve el worker o None."""
+        try:
+            msg = json.loads(await reader.readline())
+        except ValueError:
+            return None
+        if not isinstance(msg, dict) or msg.get("op") != "hello":
+            return None
+        if not hmac.compare_digest(str(msg.get("secret", "")).encode("utf-8"), self.secret.encode("utf-8")):
+            return None
+        return str(msg.get("worker", ""))
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            worker = await asyncio.wait_for(self._authenticate(reader), BUS_HELLO_TIMEOUT_S)
+        except (OSError, asyncio.TimeoutError, asyncio.CancelledError):
+            worker = None
+        if worker is None:
+            writer.close()
+            return
+        self.workers[writer] = worker
+        for uid, ws in self.holders.items():
+            for w in ws:
+                self._write(writer, {"op": "online", "user": uid, "worker": self.workers[w]})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                op = msg.get("op")
+                if op in ("online", "offline"):
+                    uid = msg.get("user")
+                    if op == "online":
+                        self.holders.setdefault(uid, set()).add(writer)
+                    else:
+                        ws = self.holders.get(uid)
+                        if ws:
+                            ws.discard(writer)
+                            if not ws:
+                                del self.holders[uid]
+                    out = {"op": op, "user": uid, "worker": self.workers[writer]}
+                    for w in self._others(writer):
+                        self._write(w, out)
+                elif op == "send":
+                    targets: Dict[asyncio.StreamWriter, list] = {}
+                    for uid in msg.get("users", ()):
+                        for w in self.holders.get(uid, ()):
+                            if w is not writer:
+                                targets.setdefault(w, []).append(uid)
+                    for w, uids in targets.items():
+                        self._write(w, {"op": "send", "users": uids, "msg": msg.get("msg")})
+                elif op in ("broadcast", "event"):
+                    for w in self._others(writer):
+                        self._write(w, msg)
+        except (OSError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass    # worker caído o broker cerrándose
+        finally:
+            worker = self.workers.pop(writer, "")
+            for uid in [u for u, ws in self.holders.items() if writer in ws]:
+                ws = self.holders[uid]
+                ws.discard(writer)
+                if not ws:
+                    del self.holders[uid]
+                for w in self.workers:
+                    self._write(w, {"op": "offline", "user": uid, "worker": worker})
+            writer.close()
+
+class BrokerBus(LocalBus):
+    """Workers conectados a un broker local (socket Unix o TCP de loopback).
+
+    El primer worker que consigue la dirección hace de broker para todos (él
+    incluido, como un cliente más); si ese proceso muere, otro ocupa su lugar al
+    reconectar. Lo enviado mientras no hay conexión se pierde: los datos ya están
+    en el backend compartido y un chat desconocido se relee de él (get_chat).
+    """
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self.broker: Optional[BusBroker] = None
+        self.remote: Dict[str, set] = {}        # user_id -> workers remotos con sockets suyos
+        self.local_users: set = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task = None
+        self.secret = ""
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+
+    async def start(self):
+        self.secret = load_bus_secret()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        if self.broker:
+            await self.broker.close()
+
+    def remote_online(self, user_id):
+        return user_id in self.remote
+
+    def remote_users(self):
+        return list(self.remote)
+
+    def _write(self, msg: dict):
+        if self._writer is None:
+            self.lost += 1
+            return
+        try:
+            self._writer.write(dumps_compact(msg).encode("utf-8") + b"\n")
+            self.sent += 1
+        except Exception:
+            self.lost += 1
+
+    def user_online(self, user_id):
+        self.local_users.add(user_id)
+        self._write({"op": "online", "user": user_id})
+
+    def user_offline(self, user_id):
+        self.local_users.discard(user_id)
+        self._write({"op": "offline", "user": user_id})
+
+    def send(self, user_ids, message):
+        self._write({"op": "send", "users": list(user_ids), "msg": message})
+
+    def broadcast(self, message):
+        self._write({"op": "broadcast", "msg": message})
+
+    def publish(self, name, **data):
+        self._write({"op": "event", "name": name, "data": data})
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await open_bus_connection(self.url)
+            except OSError:
+                # nadie escucha: se intenta hacer de broker
+                try:
+                    self.broker = await BusBroker.serve(self.url, self.secret)
+                    continue
+                except OSError:
+                    await asyncio.sleep(BUS_RECONNECT_S)
+                    continue
+            self._writer = writer
+            self._write({"op": "hello", "worker": self.worker_id, "secret": self.secret})
+            for uid in self.local_users:
+                self._write({"op": "online", "user": uid})
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.received += 1
+                    await self._dispatch(json.loads(line))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error en el bus: {e}")
+            finally:
+                self._writer = None
+                self.remote.clear()
+                writer.close()
+            await asyncio.sleep(BUS_RECONNECT_S)
+
+    async def _dispatch(self, msg: dict):
+        op = msg.get("op")
+        if op == "online":
+            self.remote.setdefault(msg["user"], set()).add(msg.get("worker"))
+        elif op == "offline":
+            ws = self.remote.get(msg["user"])
+            if ws:
+                ws.discard(msg.get("worker"))
+                if not ws:
+                    del self.remote[msg["user"]]
+        elif op == "send" and self.deliver:
+            self.deliver(msg.get("msg"), msg.get("users", ()))
+        elif op == "broadcast" and self.deliver:
+            self.deliver(msg.get("msg"), None)
+        elif op == "event":
+            fn = self.handlers.get(msg.get("name"))
+            if fn:
+                res = fn(**(msg.get("data") or {}))
+                if asyncio.iscoroutine(res):
+                    await res
+
+    def stats(self):
+        return {"kind": self.url, "worker": self.worker_id, "is_broker": self.broker is not None,
+                "connected": self._writer is not None, "remote_users": len(self.remote),
+                "sent": self.sent, "received": self.received, "lost": self.lost}
+
+def make_bus() -> LocalBus:
+    if BUS_URL.startswith(("unix:", "tcp:")):
+        return BrokerBus(BUS_URL)
+    return LocalBus()
+
+bus = make_bus()
+
+@app.on_event("startup")
+async def start_bus():
+    await bus.start()
+
+@app.on_event("shutdown")
+async def stop_bus():
+    await bus.stop()
+
+# Réplica del DataStore: cada worker tiene chats, mensajes e historias en memoria y
+# aplica aquí lo que otros han escrito ya en el backend compartido.
+def chat_added_from_bus(chat: dict):
+    if chat["id"] not in store.chats:
+        store.add_chat(chat, propagate=False)
+
+def chat_removed_from_bus(chat_id: str):
+    store.remove_chat(chat_id, propagate=False)
+
+def message_appended_from_bus(chat_id: str, message: dict):
+    if store.get_chat(chat_id) is not None and store.find_message(chat_id, msg_key(message)) is None:
+        store.append_message(chat_id, message, propagate=False)
+
+def chat_read_from_bus(chat_id: str, user_id: str, message_id: Optional[int]):
+    if store.get_chat(chat_id) is not None:
+        store.mark_read(chat_id, user_id, message_id, propagate=False)
+
+def reaction_from_bus(chat_id: str, message_id, reaction: str, user_id: str, active: bool):
+    store.apply_reaction(chat_id, message_id, reaction, user_id, active)
+
+def story_added_from_bus(story: dict):
+    store.add_story(story, propagate=False)
+
+bus.on("chat_added", chat_added_from_bus)
+bus.on("chat_removed", chat_removed_from_bus)
+bus.on("message_appended", message_appended_from_bus)
+bus.on("chat_read", chat_read_from_bus)
+bus.on("reaction", reaction_from_bus)
+bus.on("story_added", story_added_from_bus)
+
 # --- WEBSOCKET MANAGER ---
+WS_QUEUE_MAX = 256      # cola llena -> cliente demasiado lento, se desconecta
+WS_QUEUE_SOFT = 64      # por encima de esto se descartan los eventos de "escribiendo"
+WS_CLOSE_TIMEOUT_S = 2.0
+
+class Frame:
+    """Evento saliente: se serializa una sola vez, al enviarlo por primera vez,
+    y el mismo texto se reutiliza para todas las conexiones destino."""
+    __slots__ = ("message", "_text")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._text: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps_compact(self.message)
+        return self._text
+
+def as_frame(message) -> Frame:
+    return message if isinstance(message, Frame) else Frame(message)
+
+class Connection:
+    """Un WebSocket con su cola de salida acotada y su propia tarea escritora.
+
+    Política con clientes lentos: primero se descartan los typing_status, un
+    presence_delta aún no enviado absorbe los siguientes y, si la cola llega a
+    WS_QUEUE_MAX, se corta la conexión.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: str, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.manager = manager
+        self.queue: deque = deque()             # entradas [Frame] (mutables para poder fusionar)
+        self._presence: Optional[list] = None  # entrada presence_delta pendiente
+        self._wakeup = asyncio.Event()
+        self.closed = False
+        self.evicted = False                    # cerrada por el servidor (logout, ban, borrado)
+        self.typing_bucket = [TYPING_BURST, time.monotonic()]  # [fichas, última recarga]
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def enqueue(self, frame: Frame) -> bool:
+        if self.closed:
+            return False
+        message = frame.message
+        t = message.get("type")
+        if t == "typing_status" and len(self.queue) >= WS_QUEUE_SOFT:
+            self.manager.dropped += 1
+            return False
+        if t == "presence_delta" and self._presence is not None:
+            self._presence[0] = Frame(merge_presence_delta(self._presence[0].message, message))
+            self.manager.coalesced += 1
+            return True
+        if len(self.queue) >= WS_QUEUE_MAX:
+            self.manager.slow_disconnects += 1
+            self.abort()
+            return False
+        entry = [frame]
+        if t == "presence_delta":
+            self._presence = entry
+        self.queue.append(entry)
+        self._wakeup.set()
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.queue:
+                    if self.closed:
+                        break
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                entry = self.queue.popleft()
+                if entry is self._presence:
+                    self._presence = None
+                frame = entry[0]
+                await self.websocket.send_text(frame.text)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        finally:
+            self.closed = True
+            self.manager.forget(self)
+            await self._close_socket()
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Cierra tras vaciar lo pendiente."""
+        self.closed = True
+        self._wakeup.set()
+
+    def abort(self):
+        """Cierra ya, descartando lo pendiente."""
+        self.closed = True
+        self.queue.clear()
+        self._presence = None
+        self.task.cancel()
+        # si la tarea no llegó a arrancar su finally no se ejecuta: se limpia aquí
+        self.manager.forget(self)
+        asyncio.get_running_loop().create_task(self._close_socket())
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    """Sockets de este worker; lo dirigido a usuarios conectados a otro worker va por el bus."""
+
+    def __init__(self, bus: LocalBus):
+        self.bus = bus
+        bus.deliver = self.deliver_local
+        self.active_connections: Dict[str, List[Connection]] = {}
         self._lock = asyncio.Lock()
+        self.dropped = 0
+        self.coalesced = 0
+        self.slow_disconnects = 0
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str) -> Connection:
         await websocket.accept()
+        conn = Connection(websocket, user_id, self)
         async with self._lock:
-            self.active_connections.setdefault(user_id, [])
-            self.active_connections[user_id].append(websocket)
+            if user_id not in self.active_connections:
+                self.active_connections[user_id] = []
+                self.bus.user_online(user_id)
+            self.active_connections[user_id].append(conn)
+        return conn
+
+    def forget(self, conn: Connection) -> bool:
+        """Quita la conexión del registro. True si el usuario sigue teniendo otras."""
+        conns = self.active_connections.get(conn.user_id)
+        if conns is None:
+            return False
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            del self.active_connections[conn.user_id]
+            self.bus.user_offline(conn.user_id)
+            return False
+        return True
 
     async def disconnect(self, websocket: WebSocket, user_id: str) -> bool:
         """True si sigue online (otra conexión activa), False si se desconectó totalmente."""
         async with self._lock:
-            if user_id in self.active_connections:
-                if websocket in self.active_connections[user_id]:
-                    self.active_connections[user_id].remove(websocket)
-                if not self.active_connections[user_id]:
-                    del self.active_connections[user_id]
-                    return False
-                return True
-            return False
-
-    async def close_all_for_user(self, user_id: str):
-        conns = []
+            for conn in self.active_connections.get(user_id, [])[:]:
+                if conn.websocket is websocket:
+                    conn.close()
+                    self.forget(conn)
+            return user_id in self.active_connections
+
+    async def close_all_for_user(self, user_id: str, propagate: bool = True):
+        if propagate:
+            self.bus.publish("close_user", user_id=user_id)
         async with self._lock:
-            conns = self.active_connections.get(user_id, [])[:]
+            conns = self.active_connections.pop(user_id, [])
+        if conns:
+            self.bus.user_offline(user_id)
+        for conn in conns:
+            conn.evicted = True
+            conn.close()
+        if conns:
+            await asyncio.wait([c.task for c in conns], timeout=WS_CLOSE_TIMEOUT_S)
+        for conn in conns:
+            if not conn.task.done():
+                conn.abort()
+
+    def deliver_local(self, message, user_ids=None):
+        """Encola en los sockets de este worker (user_ids None = todos)."""
+        # solo encola: el envío real lo hace la tarea de cada conexión
+        frame = as_frame(message)
+        if user_ids is None:
+            targets = list(self.active_connections.values())
+        else:
+            targets = [self.active_connections.get(u, ()) for u in user_ids]
+        for conns in targets:
+            # copia: si una conexión se desborda, abort() la quita de esta misma lista
+            for conn in tuple(conns):
+                conn.enqueue(frame)
+
+    async def send_personal_message(self, message, user_id: str):
+        await self.send_to_users(message, (user_id,))
+
+    async def send_to_users(self, message, user_ids):
+        """Mismo evento a varios usuarios (p. ej. participantes de un chat), serializado una vez."""
+        self.deliver_local(message, user_ids)
+        remote = [u for u in user_ids if self.bus.remote_online(u)]
+        if remote:
+            self.bus.send(remote, as_frame(message).message)
 
-        for w in conns:
-            try:
-                await w.close()
-            except Exception:
-                pass
-
-        async with self._lock:
-            if user_id in self.active_connections:
-                del self.active_connections[user_id]
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        async with self._lock:
-            conns = self.active_connections.get(user_id, [])[:]
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.active_connections or self.bus.remote_online(user_id)
 
-        if not conns:
-            return
+    def is_local(self, user_id: str) -> bool:
+        return user_id in self.active_connections
 
-        for connection in conns:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                try:
-                    await self.disconnect(connection, user_id)
-                except Exception:
-                    pass
+    async def broadcast(self, message):
+        self.deliver_local(message)
+        self.bus.broadcast(as_frame(message).message)
+
+    def stats(self) -> dict:
+        conns = [c for cs in self.active_connections.values() for c in cs]
+        return {
+            "users_online": len(self.active_connections),
+            "users_online_elsewhere": len(self.bus.remote_users()),
+            "connections": len(conns),
+            "max_queue_depth": max((len(c.queue) for c in conns), default=0),
+            "dropped_typing": self.dropped,
+            "coalesced_presence": self.coalesced,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+manager = ConnectionManager(bus)
+
+# --- PRESENCIA ---
+PRESENCE_GRACE_S = 5.0      # una desconexión solo se anuncia si no vuelve a conectar en este margen
+PRESENCE_FLUSH_S = 1.0      # los cambios se agrupan y se envían como presence_delta cada segundo
+
+def merge_presence_delta(old: dict, new: dict) -> dict:
+    online = [u for u in old["online"] if u not in new["offline"]]
+    offline = [u for u in old["offline"] if u not in new["online"]]
+    online += [u for u in new["online"] if u not in online]
+    offline += [u for u in new["offline"] if u not in offline]
+    return {"type": "presence_delta", "online": online, "offline": offline}
+
+class PresenceService:
+    """Presencia visible para los demás, limitada a quien tiene un chat con cada usuario.
+
+    Las conexiones y desconexiones solo marcan usuarios como pendientes; flush() compara
+    el estado real con el ya anunciado y manda a cada contacto online un único
+    presence_delta con todo lo que le afecta. Las desconexiones pasan antes por un
+    periodo de gracia, así una recarga de página o un redeploy no generan parpadeos.
+    """
+
+    def __init__(self, manager: ConnectionManager, grace: float = PRESENCE_GRACE_S):
+        self.manager = manager
+        self.grace = grace
+        self.visible: set = set()               # usuarios anunciados como online
+        self._grace: Dict[str, float] = {}      # user_id -> fin del periodo de gracia
+        self._dirty: set = set()
 
     def is_online(self, user_id: str) -> bool:
-        return user_id in self.active_connections
+        return self.manager.is_online(user_id) or user_id in self._grace
 
-    async def broadcast(self, message: dict):
-        async with self._lock:
-            user_ids = list(self.active_connections.keys())
-        for user_id in user_ids:
-            await self.send_personal_message(message, user_id)
+    def connected(self, user_id: str):
+        self._grace.pop(user_id, None)
+        self._dirty.add(user_id)
 
-    async def send_presence_snapshot(self, websocket: WebSocket):
+    def disconnected(self, user_id: str, grace: bool = True):
+        if self.manager.is_online(user_id):
+            return
+        if grace:
+            self._grace[user_id] = time.monotonic() + self.grace
+        else:
+            self.gone(user_id)
+
+    def gone(self, user_id: str):
+        """Salida explícita (logout, ban, borrado): sin periodo de gracia."""
+        self._grace.pop(user_id, None)
+        self._dirty.add(user_id)
+
+    def snapshot_for(self, user_id: str) -> List[str]:
+        return [p for p in store.contacts_of(user_id) if self.is_online(p)]
+
+    async def send_snapshot(self, conn: Connection):
+        conn.enqueue(Frame({"type": "presence_snapshot", "onlineUserIds": self.snapshot_for(conn.user_id)}))
+
+    async def flush(self) -> int:
+        now = time.monotonic()
+        for uid, until in list(self._grace.items()):
+            if until <= now:
+                del self._grace[uid]
+                self._dirty.add(uid)
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, set()
+        deltas: Dict[str, Tuple[list, list]] = {}
+        for uid in dirty:
+            online = self.is_online(uid)
+            if online == (uid in self.visible):
+                continue
+            if online:
+                self.visible.add(uid)
+            else:
+                self.visible.discard(uid)
+            for p in store.contacts_of(uid):
+                if self.manager.is_online(p):
+                    deltas.setdefault(p, ([], []))[0 if online else 1].append(uid)
+        for p, (online, offline) in deltas.items():
+            await self.manager.send_personal_message(
+                {"type": "presence_delta", "online": online, "offline": offline}, p)
+        return len(deltas)
+
+    def stats(self) -> dict:
+        return {"visible": len(self.visible), "in_grace": len(self._grace), "pending": len(self._dirty)}
+
+presence = PresenceService(manager)
+
+async def close_user_from_bus(user_id: str):
+    # logout, ban o borrado hecho en otro worker
+    await manager.close_all_for_user(user_id, propagate=False)
+    presence.gone(user_id)
+
+bus.on("close_user", close_user_from_bus)
+
+# --- ESCRIBIENDO ---
+TYPING_TIMEOUT_S = 5.0      # el cliente lo refresca cada ~1s; sin refresco caduca solo
+TYPING_RATE = 4.0           # frames de typing por segundo y conexión...
+TYPING_BURST = 8            # ...con esta ráfaga máxima; el resto se ignora
+TYPING_SWEEP_INTERVAL_S = 1.0
+
+class TypingTracker:
+    """Estado de "escribiendo" por (chat, usuario): al otro lado solo llegan los cambios."""
+
+    def __init__(self, timeout: float = TYPING_TIMEOUT_S):
+        self.timeout = timeout
+        self.active: Dict[Tuple[str, str], float] = {}  # (cid, uid) -> caduca en
+        self.forwarded = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+        self.expired = 0
+
+    def allow(self, conn: Connection) -> bool:
+        tokens, last = conn.typing_bucket
+        now = time.monotonic()
+        tokens = min(TYPING_BURST, tokens + (now - last) * TYPING_RATE)
+        if tokens < 1:
+            conn.typing_bucket = [tokens, now]
+            self.rate_limited += 1
+            return False
+        conn.typing_bucket = [tokens - 1, now]
+        return True
+
+    def update(self, cid: str, user_id: str, is_typing: bool) -> bool:
+        """Registra el estado; True si ha cambiado y hay que avisar al otro."""
+        key = (cid, user_id)
+        if is_typing:
+            changed = key not in self.active
+            self.active[key] = time.monotonic() + self.timeout
+        else:
+            changed = self.active.pop(key, None) is not None
+        if changed:
+            self.forwarded += 1
+        else:
+            self.suppressed += 1
+        return changed
+
+    def expire(self) -> List[Tuple[str, str]]:
+        now = time.monotonic()
+        gone = [k for k, until in self.active.items() if until <= now]
+        for k in gone:
+            del self.active[k]
+        self.expired += len(gone)
+        return gone
+
+    def clear_user(self, user_id: str) -> List[Tuple[str, str]]:
+        gone = [k for k in self.active if k[1] == user_id]
+        for k in gone:
+            del self.active[k]
+        return gone
+
+    def stats(self) -> dict:
+        return {"active": len(self.active), "forwarded": self.forwarded, "suppressed": self.suppressed,
+                "rate_limited": self.rate_limited, "expired": self.expired}
+
+typing_state = TypingTracker()
+
+async def send_typing(cid: str, user_id: str, is_typing: bool):
+    payload = {"type": "typing_status", "chatId": cid, "fromId": user_id, "isTyping": is_typing}
+    await manager.send_to_users(payload, [p for p in store.members_of(cid) if p != user_id])
+
+async def typing_sweeper():
+    while True:
+        await asyncio.sleep(TYPING_SWEEP_INTERVAL_S)
+        for cid, user_id in typing_state.expire():
+            await send_typing(cid, user_id, False)
+
+@app.on_event("startup")
+async def start_typing_sweeper():
+    asyncio.get_running_loop().create_task(typing_sweeper())
+
+async def presence_loop():
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_S)
         try:
-            async with self._lock:
-                online = list(self.active_connections.keys())
-            await websocket.send_json({"type": "presence_snapshot", "onlineUserIds": online})
-        except Exception:
-            pass
+            await presence.flush()
+        except Exception as e:
+            print(f"Error enviando presencia: {e}")
 
-manager = ConnectionManager()
+@app.on_event("startup")
+async def start_presence_loop():
+    asyncio.get_running_loop().create_task(presence_loop())
 
 # --- AUTH HELPERS ---
+USER_CACHE_TTL_S = 30
+
 def get_user_by_id(user_id: str):
-    users = load_json(USERS_FILE, [])
-    for u in users:
-        if u.get("id") == user_id:
-            return u
-    return None
+    return store.get_user(user_id)
+
+class UserCache:
+    """Usuario autenticado por id para get_current_user y el handshake del WebSocket.
+
+    Con un backend compartido (SQLite con varios workers) las entradas caducan a los
+    USER_CACHE_TTL_S y se releen, para que un ban hecho en otro proceso se aplique.
+    Los endpoints que cambian un usuario llaman a invalidate().
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_S):
+        self.ttl = ttl
+        self._entries: Dict[str, tuple] = {}   # user_id -> (user, cargado_en)
+
+    def get(self, user_id: Optional[str]) -> Optional[dict]:
+        if not user_id:
+            return None
+        entry = self._entries.get(user_id)
+        if entry and (not store.backend.shared or time.monotonic() - entry[1] < self.ttl):
+            return entry[0]
+        u = store.refresh_user(user_id)
+        if u:
+            self._entries[user_id] = (u, time.monotonic())
+        else:
+            self._entries.pop(user_id, None)
+        return u
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+user_cache = UserCache()
+
+# Los cambios de usuario llegan con el registro entero (DataStore.add_user/update_user):
+# releerlo del backend daría la versión anterior mientras el writer del otro worker no escribe.
+def user_changed_from_bus(user: dict):
+    store.apply_user(user)
+    user_cache.invalidate(user["id"])
+
+def user_removed_from_bus(user_id: str):
+    store.remove_user(user_id, propagate=False)
+    user_cache.invalidate(user_id)
+
+bus.on("user_added", user_changed_from_bus)
+bus.on("user_changed", user_changed_from_bus)
+bus.on("user_removed", user_removed_from_bus)
+
+# --- SESIONES ---
+SESSION_BACKEND = os.environ.get("WOW_SESSIONS", "memory").lower()
+SESSIONS_FILE = os.path.join(DATA_DIR, "sessions.json")
+SESSION_TTL_S = int(os.environ.get("WOW_SESSION_TTL", str(30 * 24 * 3600)))
+SESSION_REFRESH_S = 3600        # la renovación deslizante se persiste como mucho una vez por hora
+SESSION_RECHECK_S = 30          # con backend compartido, revalidar el token cada 30s
+SESSION_SWEEP_INTERVAL_S = 60
+
+class MemorySessionBackend:
+    """Solo en memoria (comportamiento original): se pierden al reiniciar."""
+    shared = False
+
+    def bind(self, sessions: "SessionStore"):
+        self.sessions = sessions
+
+    def load(self) -> List[tuple]:
+        return []
+
+    def lookup(self, token: str) -> Optional[tuple]:
+        return None
+
+    def put(self, token: str, user_id: str, expires_at: float):
+        pass
+
+    def delete(self, tokens: List[str]):
+        pass
+
+    def delete_user_sessions(self, user_id: str):
+        pass
+
+class FileSessionBackend(MemorySessionBackend):
+    """Instantánea de todas las sesiones en data/sessions.json (agrupada por el writer)."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self):
+        return [tuple(x) for x in load_json(self.path, []) if isinstance(x, list) and len(x) == 3]
+
+    def _mark(self):
+        writer.mark("sessions", lambda: save_json(self.path, self.sessions.snapshot()))
+
+    def put(self, token, user_id, expires_at):
+        self._mark()
+
+    def delete(self, tokens):
+        self._mark()
+
+    def delete_user_sessions(self, user_id):
+        self._mark()
+
+class SQLiteSessionBackend(MemorySessionBackend):
+    """Tabla sessions en SQLite: sobrevive a reinicios y la comparten varios workers."""
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)  # escrituras (hilo del writer)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, user_id TEXT NOT NULL, expires_at REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id);
+        """)
+        self.reader = sqlite3.connect(path, check_same_thread=False)  # lecturas por PK desde el loop
+        self._ops: deque = deque()
+
+    def load(self):
+        return self.reader.execute("SELECT token, user_id, expires_at FROM sessions WHERE expires_at > ?",
+                                   (time.time(),)).fetchall()
+
+    def lookup(self, token):
+        return self.reader.execute("SELECT token, user_id, expires_at FROM sessions WHERE token = ?",
+                                   (token,)).fetchone()
+
+    def _queue(self, sql: str, params: tuple):
+        self._ops.append((sql, params))
+        writer.mark("sessions", self._drain)
+
+    def _drain(self):
+        ops = []
+        while self._ops:
+            ops.append(self._ops.popleft())
+        with self.db:
+            for sql, params in ops:
+                self.db.execute(sql, params)
+
+    def put(self, token, user_id, expires_at):
+        self._queue("INSERT OR REPLACE INTO sessions (token, user_id, expires_at) VALUES (?, ?, ?)",
+                    (token, user_id, expires_at))
+
+    def delete(self, tokens):
+        for t in tokens:
+            self._queue("DELETE FROM sessions WHERE token = ?", (t,))
+
+    def delete_user_sessions(self, user_id):
+        # también las creadas o cacheadas por otros workers (usa idx_sessions_user)
+        self._queue("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+class SessionStore:
+    """token -> (user_id, caducidad), con índice inverso user_id -> tokens y un heap de caducidades."""
+
+    def __init__(self, backend: MemorySessionBackend, ttl: int = SESSION_TTL_S):
+        self.backend = backend
+        self.ttl = ttl
+        self._tokens: Dict[str, list] = {}      # token -> [user_id, expires_at, checked_at]
+        self._by_user: Dict[str, set] = {}
+        self._heap: List[tuple] = []            # (expires_at, token); las entradas viejas se ignoran
+        backend.bind(self)
+        now = time.time()
+        for token, user_id, expires_at in backend.load():
+            if expires_at > now:
+                self._add(token, user_id, expires_at)
+
+    def _add(self, token: str, user_id: str, expires_at: float):
+        self._tokens[token] = [user_id, expires_at, time.time()]
+        self._by_user.setdefault(user_id, set()).add(token)
+        heapq.heappush(self._heap, (expires_at, token))
+
+    def _drop(self, token: str) -> Optional[str]:
+        entry = self._tokens.pop(token, None)
+        if not entry:
+            return None
+        toks = self._by_user.get(entry[0])
+        if toks:
+            toks.discard(token)
+            if not toks:
+                del self._by_user[entry[0]]
+        return entry[0]
+
+    def create(self, user_id: str) -> str:
+        token = str(uuid.uuid4())
+        expires_at = time.time() + self.ttl
+        self._add(token, user_id, expires_at)
+        self.backend.put(token, user_id, expires_at)
+        return token
+
+    def get(self, token: Optional[str]) -> Optional[str]:
+        return self.resolve(token)[0]
+
+    def resolve(self, token: Optional[str]) -> Tuple[Optional[str], bool]:
+        """(user_id, True si esta llamada ha renovado la caducidad y hay que reenviar la cookie)."""
+        if not token:
+            return None, False
+        now = time.time()
+        entry = self._tokens.get(token)
+        if entry and self.backend.shared and now - entry[2] > SESSION_RECHECK_S:
+            # otro worker pudo revocarla: se vuelve a leer del backend
+            self._drop(token)
+            entry = None
+        if not entry and self.backend.shared:
+            row = self.backend.lookup(token)
+            if row and row[2] > now:
+                self._add(row[0], row[1], row[2])
+                entry = self._tokens[token]
+        if not entry:
+            return None, False
+        if entry[1] <= now:
+            self._drop(token)
+            self.backend.delete([token])
+            return None, False
+        # renovación deslizante
+        if entry[1] - now < self.ttl - SESSION_REFRESH_S:
+            entry[1] = now + self.ttl
+            heapq.heappush(self._heap, (entry[1], token))
+            self.backend.put(token, entry[0], entry[1])
+            return entry[0], True
+        return entry[0], False
+
+    def revoke(self, token: Optional[str]) -> Optional[str]:
+        if not token:
+            return None
+        user_id = self._drop(token)
+        if user_id is None and self.backend.shared:
+            row = self.backend.lookup(token)
+            user_id = row[1] if row else None
+        self.backend.delete([token])
+        return user_id
+
+    def revoke_user(self, user_id: str) -> int:
+        tokens = list(self._by_user.get(user_id, ()))
+        for t in tokens:
+            self._drop(t)
+        self.backend.delete_user_sessions(user_id)
+        return len(tokens)
+
+    def expire(self) -> int:
+        now = time.time()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            exp, token = heapq.heappop(self._heap)
+            entry = self._tokens.get(token)
+            if entry and entry[1] == exp:
+                self._drop(token)
+                expired.append(token)
+        if expired:
+            self.backend.delete(expired)
+        return len(expired)
+
+    def snapshot(self) -> List[list]:
+        return [[t, e[0], e[1]] for t, e in list(self._tokens.items())]
+
+def make_session_backend() -> MemorySessionBackend:
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionBackend(os.environ.get("WOW_SESSION_DB", SQLITE_PATH))
+    if SESSION_BACKEND == "file":
+        return FileSessionBackend(SESSIONS_FILE)
+    return MemorySessionBackend()
+
+sessions = SessionStore(make_session_backend())
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_S)
+        sessions.expire()
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    asyncio.get_running_loop().create_task(session_sweeper())
+
+def set_session_cookie(response: Response, token: str):
+    response.set_cookie(
+        key="session_token",
+        value=token,
+        max_age=SESSION_TTL_S,
+        httponly=True,
+        samesite="lax",
+        secure=False,
+    )
 
-sessions: Dict[str, str] = {}
+class SessionCookieMiddleware:
+    """Reenvía la cookie cuando get_current_user renovó la sesión, también en los
+    endpoints que devuelven su propia Response (ahí FastAPI no añade cabeceras)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def wrapped(message):
+            if message["type"] == "http.response.start":
+                token = scope.get("state", {}).get("renewed_session")
+                if token:
+                    cookie = Response()
+                    set_session_cookie(cookie, token)
+                    message["headers"] = list(message.get("headers", ())) + [
+                        (k, v) for k, v in cookie.raw_headers if k == b"set-cookie"]
+            await send(message)
+
+        await self.app(scope, receive, wrapped)
+
+app.add_middleware(SessionCookieMiddleware)
 
 async def get_current_user(request: Request):
     token = request.cookies.get("session_token")
+    from_cookie = bool(token)
     if not token:
         auth = request.headers.get("Authorization")
         if auth and " " in auth:
             token = auth.split(" ", 1)[1]
 
-    if not token or token not in sessions:
+    user_id, extended = sessions.resolve(token)
+    if extended and from_cookie:
+        # la caducidad del servidor avanza: la cookie también (ver SessionCookieMiddleware)
+        request.state.renewed_session = token
+    if not user_id:
         raise HTTPException(status_code=401, detail="No autenticado")
 
-    user_id = sessions[token]
-    user = get_user_by_id(user_id)
+    user = user_cache.get(user_id)
 
     if not user:
-        del sessions[token]
+        sessions.revoke(token)
         raise HTTPException(status_code=401, detail="Usuario inválido")
 
     if user.get("is_banned", False):
@@ -225,23 +3051,70 @@ async def get_current_user(request: Request):
 
     return user
 
+# --- CONTRASEÑAS ---
+# bcrypt tarda ~100-300 ms y suelta el GIL: se ejecuta en un pool de hilos acotado para
+# que una ráfaga de logins no bloquee el loop (y con él los WebSockets de todos).
+PASSWORD_ROUNDS = int(os.environ.get("WOW_BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.environ.get("WOW_HASH_WORKERS", "2"))
+PASSWORD_QUEUE_MAX = int(os.environ.get("WOW_HASH_QUEUE", "64"))   # pendientes antes de responder 503
+
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=PASSWORD_ROUNDS)
+hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="pwhash")
+_hash_pending = 0
+# hash de relleno: un usuario inexistente cuesta lo mismo que una contraseña incorrecta,
+# así el tiempo de respuesta del login no revela qué nombres de usuario existen
+DUMMY_PASSWORD_HASH = pwd_context.hash(uuid.uuid4().hex)
+
+async def run_hasher(fn, *args):
+    global _hash_pending
+    if _hash_pending >= PASSWORD_QUEUE_MAX:
+        raise HTTPException(status_code=503, detail="Servidor ocupado, inténtalo de nuevo")
+    _hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, fn, *args)
+    finally:
+        _hash_pending -= 1
+
+async def hash_password(password: str) -> str:
+    return await run_hasher(pwd_context.hash, password)
+
+async def verify_password(password: str, stored: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """(correcta, hash nuevo a guardar si el registro estaba en claro o con coste antiguo)."""
+    if not stored:
+        await run_hasher(pwd_context.verify, password, DUMMY_PASSWORD_HASH)
+        return False, None
+    if not pwd_context.identify(stored):
+        # contraseña heredada en texto plano: se migra en cuanto el usuario entra
+        if not hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8")):
+            return False, None
+        return True, await hash_password(password)
+    return await run_hasher(pwd_context.verify_and_update, password, stored)
+
+@app.on_event("shutdown")
+async def stop_hash_pool():
+    hash_pool.shutdown(wait=False)
+
 # --- ENDPOINTS ---
 
 @app.post("/auth/register")
 async def register(creds: UserRegister, response: Response):
-    users = load_json(USERS_FILE, [])
-
-    if any(u.get("username", "").lower() == creds.username.lower() for u in users):
+    new_id = str(uuid.uuid4())
+    # reservado durante el hash: otro registro simultáneo con el mismo nombre falla aquí
+    if not await store.reserve_username(creds.username, new_id):
         raise HTTPException(status_code=400, detail="El nombre de usuario ya existe")
+    try:
+        password_hash = await hash_password(creds.password)
+    except BaseException:
+        store.release_username(creds.username, new_id)
+        raise
 
-    new_id = str(uuid.uuid4())
     default_seed = str(uuid.uuid4())[:8]
 
     new_user = {
         "id": new_id,
         "username": creds.username,
         "name": creds.name,
-        "password": creds.password,
+        "password": password_hash,
         "bio": "¡Hola! Estoy usando wow.",
         "avatarSeed": default_seed,
         "theme": "default",
@@ -251,73 +3124,58 @@ async def register(creds: UserRegister, response: Response):
         "is_banned": False
     }
 
-    users.append(new_user)
-    save_json(USERS_FILE, users)
+    store.add_user(new_user)
 
-    token = str(uuid.uuid4())
-    sessions[token] = new_id
-    response.set_cookie(
-        key="session_token",
-        value=token,
-        httponly=True,
-        samesite="lax",
-        secure=False,
-    )
+    token = sessions.create(new_id)
+    set_session_cookie(response, token)
 
     return {"message": "Registrado correctamente", "user": {k:v for k,v in new_user.items() if k != "password"}, "token": token}
 
 
 @app.post("/auth/login")
 async def login(creds: UserLogin, response: Response):
-    users = load_json(USERS_FILE, [])
-    user = next((u for u in users if (u.get("username","").lower() == creds.username.lower())), None)
+    user = store.get_user_by_username(creds.username)
 
-    if not user or user.get("password") != creds.password:
+    ok, new_hash = await verify_password(creds.password, user.get("password") if user else None)
+    if not ok:
         raise HTTPException(status_code=401, detail="Credenciales incorrectas")
+    if new_hash:
+        store.update_user(user["id"], {"password": new_hash})
+        user_cache.invalidate(user["id"])
 
     if user.get("is_banned", False):
         raise HTTPException(status_code=403, detail="Cuenta suspendida")
 
-    token = str(uuid.uuid4())
-    sessions[token] = user["id"]
-    response.set_cookie(
-        key="session_token",
-        value=token,
-        httponly=True,
-        samesite="lax",
-        secure=False,
-    )
+    token = sessions.create(user["id"])
+    set_session_cookie(response, token)
     return {"message": "OK", "user": {k:v for k,v in user.items() if k != "password"}, "token": token}
 
 
 @app.post("/auth/logout")
 async def logout(response: Response, request: Request):
     token = request.cookies.get("session_token")
-    user_id = sessions.get(token) if token else None
-
-    if token in sessions:
-        del sessions[token]
+    user_id = sessions.revoke(token)
 
     response.delete_cookie("session_token")
 
     if user_id:
         await manager.close_all_for_user(user_id)
-        await manager.broadcast({"type": "user_status", "userId": user_id, "status": "offline"})
+        presence.gone(user_id)
 
     return {"message": "OK"}
 
 
 @app.post("/auth/change-password")
 async def change_pass(req: ChangePasswordRequest, user: dict = Depends(get_current_user)):
-    users = load_json(USERS_FILE, [])
-    for i, u in enumerate(users):
-        if u["id"] == user["id"]:
-            if u.get("password") != req.current_password:
-                raise HTTPException(status_code=400, detail="Password actual incorrecto")
-            users[i]["password"] = req.new_password
-            save_json(USERS_FILE, users)
-            return {"message": "Password actualizado"}
-    raise HTTPException(404, detail="Error interno")
+    u = store.get_user(user["id"])
+    if not u:
+        raise HTTPException(404, detail="Error interno")
+    ok, _ = await verify_password(req.current_password, u.get("password"))
+    if not ok:
+        raise HTTPException(status_code=400, detail="Password actual incorrecto")
+    store.update_user(u["id"], {"password": await hash_password(req.new_password)})
+    user_cache.invalidate(u["id"])
+    return {"message": "Password actualizado"}
 
 
 @app.get("/api/me")
@@ -327,29 +3185,24 @@ async def me(user: dict = Depends(get_current_user)):
 
 @app.post("/api/me/profile")
 async def update_profile(p: UserProfileUpdate, user: dict = Depends(get_current_user)):
-    users = load_json(USERS_FILE, [])
-
-    for u in users:
-        if u.get("username","").lower() == p.username.lower() and u["id"] != user["id"]:
-            raise HTTPException(status_code=400, detail="Nombre de usuario en uso")
-
-    for i, u in enumerate(users):
-        if u["id"] == user["id"]:
-            users[i].update(p.dict())
-            save_json(USERS_FILE, users)
-            return {k:v for k,v in users[i].items() if k != "password"}
+    if not await store.reserve_username(p.username, user["id"]):
+        raise HTTPException(status_code=400, detail="Nombre de usuario en uso")
 
-    raise HTTPException(404, detail="No encontrado")
+    u = store.update_user(user["id"], p.dict())
+    store.release_username(p.username, user["id"])
+    user_cache.invalidate(user["id"])
+    if not u:
+        raise HTTPException(404, detail="No encontrado")
+    return {k:v for k,v in u.items() if k != "password"}
 
 
 @app.get("/api/users")
-async def list_users(user: dict = Depends(get_current_user)):
-    users = load_json(USERS_FILE, [])
-    return [
-        {k:v for k,v in u.items() if k != "password"}
-        for u in users
-        if u["id"] != user["id"] and not u.get("is_banned", False)
-    ]
+async def list_users(q: str = "", limit: int = USERS_PAGE_SIZE, offset: int = 0,
+                     user: dict = Depends(get_current_user)):
+    # Directorio paginado: sin q, todos por orden de alta; con q, búsqueda en el índice.
+    limit = max(1, min(limit, USERS_PAGE_MAX))
+    offset = max(0, offset)
+    return [user_public(u) for u in store.search_users(q, limit, offset, exclude_id=user["id"])]
 
 
 @app.get("/api/users/{uid}")
@@ -364,11 +3217,14 @@ async def get_profile(uid: str, user: dict = Depends(get_current_user)):
 # --- STORIES ENDPOINTS ---
 
 @app.get("/api/stories")
-async def get_stories(user: dict = Depends(get_current_user)):
-    stories = load_stories_clean()
+async def get_stories(request: Request, user: dict = Depends(get_current_user)):
+    # Solo metadatos: "thumb" es una miniatura y "image" la URL del original, que el
+    # cliente pide al abrir la historia (blobs con caché immutable).
+    stories = store.active_stories()
+    authors = store.get_users(s.get("userId") for s in stories)
     out = []
     for s in stories:
-        u = get_user_by_id(s.get("userId"))
+        u = authors.get(s.get("userId"))
         if not u:
             continue
         if u.get("is_banned", False) and not user.get("is_admin", False):
@@ -376,13 +3232,21 @@ async def get_stories(user: dict = Depends(get_current_user)):
         out.append({
             "id": s.get("id"),
             "image": s.get("image"),
+            "thumb": s.get("thumb") or s.get("image"),
             "caption": s.get("caption", "") or "",
             "createdAt": s.get("createdAt"),
             "expiresAt": s.get("expiresAt"),
             "user": story_user_public(u),
         })
     out.sort(key=lambda x: int(x.get("createdAt") or 0), reverse=True)
-    return out
+
+    # tras cada stories_updated el cliente vuelve a pedirlo: 304 si no ha cambiado
+    body = dumps_bytes(out)
+    etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 @app.post("/api/stories")
 async def create_story(req: StoryCreate, user: dict = Depends(get_current_user)):
@@ -394,32 +3258,82 @@ async def create_story(req: StoryCreate, user: dict = Depends(get_current_user))
     if len(img) > 2_500_000:
         raise HTTPException(status_code=413, detail="Imagen demasiado grande")
 
+    media = await run_media(process_media, img, True)
+    if not media:
+        raise HTTPException(status_code=400, detail="Imagen inválida")
+    image_url, thumb_url = media["url"], media.get("thumb")
+
     cap = (req.caption or "").strip()
     t = now_ms()
     story = {
         "id": str(uuid.uuid4()),
         "userId": user["id"],
-        "image": img,
+        "image": image_url,
         "caption": cap[:300],
         "createdAt": t,
         "expiresAt": t + STORY_TTL_MS
     }
+    if thumb_url:
+        story["thumb"] = thumb_url
 
-    stories = load_stories_clean()
-    stories.append(story)
-    save_json(STORIES_FILE, stories)
+    store.add_story(story)
 
     await manager.broadcast({"type": "stories_updated"})
     return {"message": "OK", "storyId": story["id"]}
 
+# --- BLOBS ENDPOINT ---
+
+@app.get("/api/blobs/{blob_id}")
+async def get_blob(blob_id: str, request: Request, user: dict = Depends(get_current_user)):
+    path = blobs.path(blob_id)
+    if not path or not os.path.isfile(path):
+        raise HTTPException(404, detail="No encontrado")
+
+    etag = f'"{blob_id.split(".", 1)[0]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    start, end, status = 0, size - 1, 200
+    rng = request.headers.get("range")
+    if rng:
+        m = re.match(r"^bytes=(\d*)-(\d*)$", rng.strip())
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(0, size - int(m.group(2)))
+            if start > end or start >= size:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file(path, start, end), status_code=status,
+                             media_type=blobs.mime(blob_id), headers=headers)
+
 # --- ADMIN ENDPOINTS ---
 
+@app.get("/api/admin/metrics")
+async def admin_metrics(user: dict = Depends(get_current_user)):
+    if not user.get("is_admin"):
+        raise HTTPException(403, detail="Forbidden")
+    persistence = writer.stats()
+    persistence.update(store.backend.stats())
+    return {"persistence": persistence, "websockets": manager.stats(), "presence": presence.stats(),
+            "typing": typing_state.stats(), "bus": bus.stats(), "static": static_files.stats()}
+
 @app.get("/api/admin/all_users")
 async def admin_list(user: dict = Depends(get_current_user)):
     if not user.get("is_admin"):
         raise HTTPException(403, detail="Forbidden")
-    users = load_json(USERS_FILE, [])
-    return [{k:v for k,v in u.items() if k != "password"} for u in users]
+    return FastJSONResponse([{k:v for k,v in u.items() if k != "password"} for u in store.users.values()])
 
 
 @app.post("/api/admin/users/{uid}/toggle_ban")
@@ -429,26 +3343,23 @@ async def toggle_ban(uid: str, user: dict = Depends(get_current_user)):
     if uid == user["id"]:
         raise HTTPException(400, detail="No puedes banearte a ti mismo")
 
-    users = load_json(USERS_FILE, [])
-    for i, u in enumerate(users):
-        if u["id"] == uid:
-            users[i]["is_banned"] = not u.get("is_banned", False)
-            save_json(USERS_FILE, users)
+    u = store.get_user(uid)
+    if not u:
+        raise HTTPException(404, detail="No encontrado")
 
-            if users[i]["is_banned"]:
-                await manager.send_personal_message({"type": "banned"}, uid)
-                await asyncio.sleep(0.2)
+    store.update_user(uid, {"is_banned": not u.get("is_banned", False)})
+    user_cache.invalidate(uid)
 
-                to_del = [k for k, v in sessions.items() if v == uid]
-                for k in to_del:
-                    del sessions[k]
+    if u["is_banned"]:
+        await manager.send_personal_message({"type": "banned"}, uid)
+        await asyncio.sleep(0.2)
 
-                await manager.close_all_for_user(uid)
-                await manager.broadcast({"type": "user_status", "userId": uid, "status": "offline"})
+        sessions.revoke_user(uid)
 
-            return {"status": users[i]["is_banned"]}
+        await manager.close_all_for_user(uid)
+        presence.gone(uid)
 
-    raise HTTPException(404, detail="No encontrado")
+    return {"status": u["is_banned"]}
 
 
 @app.delete("/api/admin/users/{uid}")
@@ -458,21 +3369,14 @@ async def delete_user(uid: str, user: dict = Depends(get_current_user)):
     if uid == user["id"]:
         raise HTTPException(400, detail="No puedes borrar tu propia cuenta")
 
-    users = load_json(USERS_FILE, [])
-    initial_len = len(users)
-    users = [u for u in users if u["id"] != uid]
-
-    if len(users) == initial_len:
+    if not store.remove_user(uid):
         raise HTTPException(404, detail="Usuario no encontrado")
+    user_cache.invalidate(uid)
 
-    save_json(USERS_FILE, users)
-
-    to_del = [k for k, v in sessions.items() if v == uid]
-    for k in to_del:
-        del sessions[k]
+    sessions.revoke_user(uid)
 
     await manager.close_all_for_user(uid)
-    await manager.broadcast({"type": "user_status", "userId": uid, "status": "offline"})
+    presence.gone(uid)
 
     return {"message": "Usuario eliminado"}
 
@@ -482,50 +3386,38 @@ async def admin_delete_chat(cid: str, user: dict = Depends(get_current_user)):
     if not user.get("is_admin"):
         raise HTTPException(403, detail="Forbidden")
 
-    chats = load_json(CHATS_FILE, [])
-    idx = next((i for i, c in enumerate(chats) if c.get("id") == cid), -1)
-    if idx == -1:
+    chat = store.remove_chat(cid)
+    if not chat:
         raise HTTPException(404, detail="Chat no encontrado")
 
-    participants = chats[idx].get("participants", [])[:]
-    del chats[idx]
-    save_json(CHATS_FILE, chats)
+    participants = chat.get("participants", [])[:]
 
-    payload = {"type": "chat_deleted", "chatId": cid}
-    for p in participants:
-        await manager.send_personal_message(payload, p)
+    await manager.send_to_users({"type": "chat_deleted", "chatId": cid}, participants)
 
     return {"message": "Chat eliminado", "chatId": cid}
 
 
 @app.get("/api/chats")
 async def get_chats(user: dict = Depends(get_current_user)):
-    chats = load_json(CHATS_FILE, [])
+    chats = store.chats_for_user(user["id"])
+    other_ids = {c["id"]: next((p for p in c["participants"] if p != user["id"]), None) for c in chats}
+    others = store.get_users(oid for oid in other_ids.values() if oid)
     res = []
 
     for c in chats:
-        if user["id"] in c.get("participants", []):
-            other_id = next((p for p in c["participants"] if p != user["id"]), None)
-            other = get_user_by_id(other_id) if other_id else None
-            if not other:
-                continue
-
-            is_online = manager.is_online(other["id"])
-            last = c["messages"][-1] if c.get("messages") else None
+        other = others.get(other_ids[c["id"]])
+        if not other:
+            continue
 
-            res.append({
-                "id": c["id"],
-                "otherUser": {
-                    "id": other["id"],
-                    "name": other.get("name",""),
-                    "avatarSeed": other.get("avatarSeed",""),
-                    "status": "Suspendido" if other.get("is_banned") else ("En línea" if is_online else "Desconectado"),
-                    "is_online": is_online
-                },
-                "lastMessage": last,
-                "unread": 0
-            })
-    return res
+        res.append({
+            "id": c["id"],
+            "otherUser": chat_user_public(other, presence.is_online(other["id"])),
+            "lastMessage": c.get("lastMessage"),
+            "lastActivity": c.get("lastActivity"),
+            "unread": c.get("unread", {}).get(user["id"], 0)
+        })
+    # listas grandes de dicts planos: se serializan directamente, sin jsonable_encoder
+    return FastJSONResponse(res)
 
 
 @app.post("/api/chats")
@@ -537,41 +3429,41 @@ async def create_chat(req: CreateChatRequest, user: dict = Depends(get_current_u
     if not target or (target.get("is_banned") and not user.get("is_admin")):
         raise HTTPException(404, detail="Usuario no disponible")
 
-    chats = load_json(CHATS_FILE, [])
-    for c in chats:
-        if user["id"] in c.get("participants", []) and req.target_user_id in c.get("participants", []):
-            return {"id": c["id"], "messages": c.get("messages", [])}
+    # solo el id: el historial se pide paginado (GET /api/chats/{cid}/messages)
+    c = store.find_chat_between(user["id"], req.target_user_id)
+    if c:
+        return {"id": c["id"]}
 
     new_chat = {
         "id": str(uuid.uuid4()),
         "participants": [user["id"], req.target_user_id],
         "messages": []
     }
-    chats.append(new_chat)
-    save_json(CHATS_FILE, chats)
-    return {"id": new_chat["id"], "messages": []}
+    store.add_chat(new_chat)
+    return {"id": new_chat["id"]}
 
 
 @app.get("/api/chats/{cid}/messages")
-async def get_msgs(cid: str, user: dict = Depends(get_current_user)):
-    chats = load_json(CHATS_FILE, [])
-    c = next((x for x in chats if x.get("id") == cid), None)
+async def get_msgs(cid: str, before: Optional[int] = None, after: Optional[int] = None,
+                   limit: int = MESSAGES_PAGE_SIZE, user: dict = Depends(get_current_user)):
+    c = store.get_chat(cid)
     if not c or user["id"] not in c.get("participants", []):
         raise HTTPException(404, detail="No encontrado")
-    return c.get("messages", [])
+    limit = max(1, min(limit, MESSAGES_PAGE_MAX))
+    return FastJSONResponse(store.page_messages(cid, before=before, after=after, limit=limit))
 
 
 @app.websocket("/ws/{uid}")
 async def ws_endpoint(websocket: WebSocket, uid: str):
     token = websocket.cookies.get("session_token")
-    if not token or token not in sessions or sessions[token] != uid:
+    if sessions.get(token) != uid:
         try:
             await websocket.close(code=1008)
         except Exception:
             pass
         return
 
-    u = get_user_by_id(uid)
+    u = user_cache.get(uid)
     if not u or u.get("is_banned", False):
         try:
             await websocket.close(code=1008)
@@ -579,9 +3471,9 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
             pass
         return
 
-    await manager.connect(websocket, uid)
-    await manager.send_presence_snapshot(websocket)
-    await manager.broadcast({"type": "user_status", "userId": uid, "status": "online"})
+    conn = await manager.connect(websocket, uid)
+    presence.connected(uid)
+    await presence.send_snapshot(conn)
 
     try:
         while True:
@@ -596,29 +3488,25 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                 if not chatId:
                     continue
                 
-                # Cargar chats para validar y encontrar al 'otro'
-                chats = load_json(CHATS_FILE, [])
-                chat = next((c for c in chats if c.get("id") == chatId), None)
-                
-                if chat and uid in chat.get("participants", []):
-                    other_id = next((p for p in chat["participants"] if p != uid), None)
-                    
-                    if other_id:
-                        # Para CALL_INVITE, podemos comprobar si está online primero
-                        if t == "call_invite":
-                            if not manager.is_online(other_id):
-                                await manager.send_personal_message({
-                                    "type": "call_unavailable",
-                                    "chatId": chatId,
-                                    "reason": "offline"
-                                }, uid)
-                                continue
-
-                        # Reenviar el mensaje tal cual al otro usuario
-                        # Añadimos fromId para que sepa quién lo manda
-                        payload = data.copy()
-                        payload["fromId"] = uid
-                        await manager.send_personal_message(payload, other_id)
+                # Validar el chat y encontrar al 'otro' (mapa de miembros en memoria)
+                other_id = store.chat_partner(chatId, uid)
+
+                if other_id:
+                    # Para CALL_INVITE, podemos comprobar si está online primero
+                    if t == "call_invite":
+                        if not manager.is_online(other_id):
+                            await manager.send_personal_message({
+                                "type": "call_unavailable",
+                                "chatId": chatId,
+                                "reason": "offline"
+                            }, uid)
+                            continue
+
+                    # Reenviar el mensaje tal cual al otro usuario
+                    # Añadimos fromId para que sepa quién lo manda
+                    payload = data.copy()
+                    payload["fromId"] = uid
+                    await manager.send_personal_message(payload, other_id)
 
             elif t == "send_message":
                 cid = data.get("chatId")
@@ -626,20 +3514,37 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                 if not cid or not txt:
                     continue
 
-                chats = load_json(CHATS_FILE, [])
-                idx = next((i for i, c in enumerate(chats) if c.get("id") == cid), -1)
-                if idx == -1:
+                chat = store.get_chat(cid)
+                if not chat:
                     continue
 
-                if uid not in chats[idx].get("participants", []):
+                if uid not in chat.get("participants", []):
                     continue
 
                 kind = data.get("kind")
                 duration = data.get("duration")
                 peaks = data.get("peaks")
+                if not kind and isinstance(txt, str):
+                    if txt.startswith("data:audio"):
+                        kind = "audio"
+                    elif txt.startswith("data:image"):
+                        kind = "image"
+
+                # Los medios se procesan antes de asignar id: así el mensaje se emite (y se
+                # añade al log) ya con su blob definitivo y sin desordenar los ids del chat.
+                media = None
+                if kind in ("audio", "image") and is_media_data_url(txt):
+                    media = await run_media(process_media, txt)
+                    if not media:
+                        continue
+                    txt = media["url"]
+                    # durante el await pudieron borrar el chat (admin)
+                    chat = store.get_chat(cid)
+                    if not chat or uid not in chat.get("participants", []):
+                        continue
 
                 msg: Dict[str, Any] = {
-                    "id": int(time.time() * 1000),
+                    "id": store.next_message_id(cid),
                     "fromId": uid,
                     "text": txt,
                     "time": time.strftime("%H:%M"),
@@ -648,12 +3553,7 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                 # Reply-to: solo aceptamos id y resolvemos en servidor
                 reply_to = data.get("replyTo")
                 if isinstance(reply_to, dict) and reply_to.get("id") is not None:
-                    rid = str(reply_to.get("id"))
-                    target = None
-                    for m in chats[idx].get("messages", []):
-                        if str(m.get("id")) == rid:
-                            target = m
-                            break
+                    target = store.find_message(cid, reply_to.get("id"))
                     if target:
                         msg["replyTo"] = {
                             "id": target.get("id"),
@@ -664,15 +3564,10 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
 
                 if kind:
                     msg["kind"] = kind
-                else:
-                    if isinstance(txt, str) and txt.startswith("data:audio"):
-                        msg["kind"] = "audio"
-                    elif isinstance(txt, str) and txt.startswith("data:image"):
-                        msg["kind"] = "image"
 
                 if msg.get("kind") == "audio":
-                    if isinstance(duration, (int, float)):
-                        msg["duration"] = int(duration)
+                    if isinstance(duration, (int, float)) and math.isfinite(duration):
+                        msg["duration"] = int(min(max(duration, 0), VOICE_MAX_S))
                     if isinstance(peaks, list):
                         clean = []
                         for v in peaks:
@@ -684,38 +3579,41 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                             except Exception:
                                 continue
                         msg["peaks"] = clean[:128]
+                    # lo medido en el servidor (WAV) manda sobre lo que dice el cliente
+                    if media and "duration" in media:
+                        msg["duration"] = media["duration"]
+                    if media and media.get("peaks"):
+                        msg["peaks"] = media["peaks"]
 
                 msg.setdefault("reactions", {})
 
-                chats[idx].setdefault("messages", []).append(msg)
-                save_json(CHATS_FILE, chats)
+                store.append_message(cid, msg)
+
+                if typing_state.update(cid, uid, False):
+                    await send_typing(cid, uid, False)
 
                 payload = {"type": "new_message", "chatId": cid, "message": msg}
-                for p in chats[idx].get("participants", []):
-                    await manager.send_personal_message(payload, p)
+                await manager.send_to_users(payload, chat.get("participants", []))
 
             elif t == "react_message":
                 cid = data.get("chatId")
                 mid = data.get("messageId")
                 reaction = data.get("reaction") or "heart"
+                if not isinstance(reaction, str):
+                    reaction = str(reaction)
+                reaction = reaction[:REACTION_MAX_LEN]
 
                 if not cid or mid is None:
                     continue
 
-                chats = load_json(CHATS_FILE, [])
-                chat = next((c for c in chats if c.get("id") == cid), None)
+                chat = store.get_chat(cid)
                 if not chat:
                     continue
 
                 if uid not in chat.get("participants", []):
                     continue
 
-                target = None
-                for m in chat.get("messages", []):
-                    if str(m.get("id")) == str(mid):
-                        target = m
-                        break
-
+                target = store.find_message(cid, mid)
                 if not target:
                     continue
 
@@ -731,7 +3629,7 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                     lst.append(uid)
                     active = True
 
-                save_json(CHATS_FILE, chats)
+                store.record_reaction(cid, target, reaction, uid, active)
 
                 payload = {
                     "type": "message_reaction",
@@ -743,10 +3641,27 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                     "reactions": target.get("reactions", {})
                 }
 
-                for p in chat.get("participants", []):
-                    await manager.send_personal_message(payload, p)
+                await manager.send_to_users(payload, chat.get("participants", []))
+
+            elif t == "mark_read":
+                cid = data.get("chatId")
+                chat = store.get_chat(cid)
+                if not chat or uid not in chat.get("participants", []):
+                    continue
+
+                mid = data.get("messageId")
+                try:
+                    mid = int(mid) if mid is not None else None
+                except (TypeError, ValueError):
+                    continue
+
+                cursor = store.mark_read(cid, uid, mid)
+                payload = {"type": "chat_read", "chatId": cid, "userId": uid, "messageId": cursor}
+                await manager.send_to_users(payload, chat.get("participants", []))
 
             elif t in ("typing", "typing_status", "is_typing"):
+                if not typing_state.allow(conn):
+                    continue
                 cid = data.get("chatId")
                 is_typing = bool(
                     data.get("isTyping") if "isTyping" in data else
@@ -755,50 +3670,166 @@ async def ws_endpoint(websocket: WebSocket, uid: str):
                     False
                 )
 
-                chats = load_json(CHATS_FILE, [])
-                chat = next((c for c in chats if c.get("id") == cid), None)
-                if not chat:
+                if uid not in store.members_of(cid):
                     continue
 
-                payload = {
-                    "type": "typing_status",
-                    "chatId": cid,
-                    "fromId": uid,
-                    "isTyping": is_typing
-                }
-                for p in chat.get("participants", []):
-                    if p != uid:
-                        await manager.send_personal_message(payload, p)
+                # solo cambios de estado; los refrescos solo alargan la caducidad
+                if typing_state.update(cid, uid, is_typing):
+                    await send_typing(cid, uid, is_typing)
 
     except Exception:
         pass
     finally:
         still_online = await manager.disconnect(websocket, uid)
         if not still_online:
-            await manager.broadcast({"type": "user_status", "userId": uid, "status": "offline"})
-
+            presence.disconnected(uid, grace=not conn.evicted)
+            for cid, _ in typing_state.clear_user(uid):
+                await send_typing(cid, uid, False)
+
+
+# --- ESTÁTICOS ---
+# public/ se lee una vez a memoria: cada fichero con su ETag y sus variantes gzip/brotli
+# ya comprimidas. Los assets tienen además un alias con huella (app.<hash>.js) que es el
+# que referencia index.html y se sirve como immutable; index.html se revalida siempre.
+STATIC_COMPRESS_MIN = 1024
+STATIC_COMPRESSIBLE = {".html", ".js", ".css", ".svg", ".json", ".txt", ".map", ".webmanifest"}
+# extensiones que nunca son una ruta del SPA (/u/john.doe sí lo es)
+STATIC_EXTENSIONS = STATIC_COMPRESSIBLE | {".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico",
+                                           ".woff", ".woff2", ".ttf", ".mp3", ".ogg", ".wav"}
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+STATIC_REVALIDATE = "no-cache"
+ASSET_REF_RE = re.compile(r'((?:src|href)=")(\./)?(assets/[^"?#]+)(?:\?[^"#]*)?(")')
+
+class StaticAsset:
+    __slots__ = ("body", "mime", "etag", "gzip", "br", "cache_control")
+
+    def __init__(self, body: bytes, mime: str, cache_control: str, compress: bool = True):
+        self.body = body
+        self.mime = mime
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:20]}"'
+        self.cache_control = cache_control
+        self.gzip = self.br = None
+        if compress and len(body) >= STATIC_COMPRESS_MIN:
+            gz = gzip.compress(body, 9, mtime=0)
+            if len(gz) < len(body):
+                self.gzip = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.br = br
+
+    def immutable(self) -> "StaticAsset":
+        """Copia (comparte los bytes) para servir bajo el nombre con huella."""
+        twin = StaticAsset.__new__(StaticAsset)
+        for slot in StaticAsset.__slots__:
+            setattr(twin, slot, getattr(self, slot))
+        twin.cache_control = STATIC_IMMUTABLE
+        return twin
+
+    def respond(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if request.headers.get("if-none-match") == self.etag:
+            return Response(status_code=304, headers=headers)
+        accept = accepted_encodings(request.headers.get("accept-encoding", ""))
+        body = self.body
+        if self.br is not None and "br" in accept:
+            body = self.br
+            headers["Content-Encoding"] = "br"
+        elif self.gzip is not None and "gzip" in accept:
+            body = self.gzip
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, media_type=self.mime, headers=headers)
+
+class StaticManifest:
+    def __init__(self, root: str):
+        self.root = root
+        self.files: Optional[Dict[str, StaticAsset]] = None
+        self.fingerprints: Dict[str, str] = {}   # assets/app.js -> assets/app.<hash>.js
+
+    def _read(self) -> Dict[str, bytes]:
+        out = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for fn in filenames:
+                if fn.startswith(".") or fn.endswith((".bak", ".tmp")):
+                    continue
+                full = os.path.join(dirpath, fn)
+                rel = os.path.relpath(full, self.root).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    out[rel] = f.read()
+        return out
+
+    def _asset(self, rel: str, body: bytes, cache_control: str) -> StaticAsset:
+        mime = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+        if mime.startswith("text/") or mime in ("application/javascript", "application/json"):
+            mime += "; charset=utf-8"
+        compress = os.path.splitext(rel)[1].lower() in STATIC_COMPRESSIBLE
+        return StaticAsset(body, mime, cache_control, compress)
+
+    def build(self):
+        raw = self._read()
+        files: Dict[str, StaticAsset] = {}
+        fingerprints: Dict[str, str] = {}
+        for rel, body in raw.items():
+            if rel.endswith(".html"):
+                continue
+            asset = files[rel] = self._asset(rel, body, STATIC_REVALIDATE)
+            stem, ext = os.path.splitext(rel)
+            hashed = f"{stem}.{asset.etag[1:11]}{ext}"
+            files[hashed] = asset.immutable()
+            fingerprints[rel] = hashed
+
+        def rewrite(m):
+            target = fingerprints.get(m.group(3))
+            if not target:
+                return m.group(0)
+            return f"{m.group(1)}{m.group(2) or ''}{target}{m.group(4)}"
+
+        for rel, body in raw.items():
+            if rel.endswith(".html"):
+                html = ASSET_REF_RE.sub(rewrite, body.decode("utf-8"))
+                files[rel] = self._asset(rel, html.encode("utf-8"), STATIC_REVALIDATE)
+        self.files, self.fingerprints = files, fingerprints
+
+    def lookup(self, path: str) -> Optional[StaticAsset]:
+        if self.files is None:
+            self.build()
+        return self.files.get(path)
+
+    def stats(self) -> dict:
+        files = self.files or {}
+        return {"files": len(files), "fingerprinted": len(self.fingerprints),
+                "bytes": sum(len(a.body) for a in files.values()),
+                "gzip_bytes": sum(len(a.gzip or a.body) for a in files.values())}
+
+static_files = StaticManifest(PUBLIC_DIR)
+
+@app.on_event("startup")
+async def build_static_manifest():
+    await asyncio.to_thread(static_files.build)
 
 @app.get("/{path:path}")
-async def serve_static(path: str):
+async def serve_static(path: str, request: Request):
     # API/Auth guards
     if path.startswith(("api/", "auth/", "ws/")):
         return JSONResponse({"error": "Not found"}, status_code=404)
 
-    # Construct file path
-    file_path = os.path.join(PUBLIC_DIR, path)
-
-    # If path is empty, serve index.html
-    if path == "" or path == "/":
-        return FileResponse(os.path.join(PUBLIC_DIR, "index.html"))
+    path = path.lstrip("/") or "index.html"
+    asset = static_files.lookup(path)
+    if asset is not None:
+        return asset.respond(request)
 
-    # If file exists and is a file, serve it (CSS, JS, assets)
-    if os.path.isfile(file_path):
-        return FileResponse(file_path)
-
-    # SPA Fallback -> index.html
-    return FileResponse(os.path.join(PUBLIC_DIR, "index.html"))
+    # Un fichero que no existe (p. ej. un asset con huella de un despliegue anterior) es
+    # un 404; el resto son rutas del SPA -> index.html
+    if path.startswith("assets/") or os.path.splitext(path)[1].lower() in STATIC_EXTENSIONS:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    return static_files.lookup("index.html").respond(request)
 
 # Importante para ejecución local (no afecta a Vercel)
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-sqlite":
+        # python server.py migrate-sqlite [ruta.db]
+        migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else SQLITE_PATH)
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)